@@ -0,0 +1,217 @@
+#! /usr/bin/env python3
+"""Benchmark betamatch and corrplot on synthetic data.
+
+Generates a bgzipped, tabix-indexed FinnGen summary and an external summary with allele edge cases
+(strand-ambiguous pairs, strand flips, swapped alleles, indels, lowercase alleles, invalid alleles, missing SE),
+times each matching stage and writes the timings as json. Results can be compared against a stored baseline:
+
+    bench_betamatch.py --out baseline.json
+    bench_betamatch.py --out current.json --baseline baseline.json
+"""
+import argparse, json, os, platform, random, sys, tempfile, time
+from collections import OrderedDict
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np #type: ignore
+import pandas as pd #type: ignore
+
+from betamatch import ExtCols, FGCols, MatchOptions, read_ext, open_fg, join_betas, process_ext_group, UNIFIED_PREFIX
+from beta_utils import impute_se, calculate_r2, calculate_regression
+from harmonize import harmonize, valid_alleles
+from fg_lookup import lookup_fg
+from bgzf import BgzfWriter, tabix_index
+
+#execute lazily imported modules up front, so that their import time is not counted in the first stage using them
+import scipy.stats, plotnine #type: ignore
+scipy.stats.norm, plotnine.ggplot
+
+FG_COLS=FGCols("#chrom","pos","ref","alt","beta","pval","sebeta")
+EXT_COLS=ExtCols("chr","pos","ref","alt","beta","pval","se","study_doi")
+CHROMS=[str(c) for c in range(1,23)]+["X"]
+COMPLEMENT={"A":"T","C":"G","G":"C","T":"A"}
+
+def random_allele(rng):
+    if rng.random() < 0.85:
+        return rng.choice("ACGT")
+    return "".join(rng.choice("ACGT") for _ in range(rng.randint(2,8)))
+
+def generate_fg(path, n_variants, rng):
+    """Write a sorted, bgzipped and tabix-indexed fg summary
+    In: file path, number of variants, random generator
+    Out: list of variant tuples
+    """
+    per_chrom=n_variants//len(CHROMS)+1
+    variants=[]
+    with BgzfWriter(path) as f:
+        f.write("\t".join(FG_COLS)+"\tmaf\n")
+        for chrom in CHROMS:
+            pos=0
+            for _ in range(per_chrom):
+                pos+=rng.randint(1,400)
+                ref=random_allele(rng)
+                alt=random_allele(rng)
+                if rng.random() < 0.05:
+                    #strand ambiguous pair
+                    ref,alt=rng.choice([("A","T"),("T","A"),("C","G"),("G","C")])
+                beta=rng.gauss(0,0.1)
+                pval=10**-rng.uniform(0,15)
+                se=rng.uniform(0.005,0.2)
+                variants.append((chrom,pos,ref,alt,beta,pval,se))
+                f.write("{}\t{}\t{}\t{}\t{:.5g}\t{:.4g}\t{:.4g}\t{:.3f}\n".format(chrom,pos,ref,alt,beta,pval,se,rng.random()/2))
+    tabix_index(path,1,2,2,"#",0)
+    return variants
+
+def generate_ext(path, fg_variants, n_variants, rng):
+    """Write an external summary with allele edge cases
+    In: file path, fg variants, number of variants, random generator
+    """
+    with open(path,"w") as f:
+        f.write("\t".join(EXT_COLS)+"\ttrait\n")
+        for chrom,pos,ref,alt,beta,pval,se in rng.sample(fg_variants,min(n_variants,len(fg_variants))):
+            case=rng.random()
+            if case < 0.2:
+                ref,alt,beta=alt,ref,-beta
+            elif case < 0.3:
+                ref="".join(COMPLEMENT[b] for b in ref)
+                alt="".join(COMPLEMENT[b] for b in alt)
+            elif case < 0.35:
+                ref=ref.lower()
+            elif case < 0.37:
+                alt=rng.choice(["-","I","D",""])
+            elif case < 0.4:
+                #not in the fg file
+                pos+=1
+            se_field="" if rng.random() < 0.3 else "{:.4g}".format(se)
+            f.write("{}\t{}\t{}\t{}\t{:.5g}\t{:.4g}\t{}\tdoi:benchmark\tTRAIT\n".format(chrom,pos,ref,alt,beta+rng.gauss(0,0.01),pval,se_field))
+
+class Timer:
+    def __init__(self):
+        self.stages=OrderedDict()
+
+    def __call__(self, stage, func, *args, **kwargs):
+        start=time.perf_counter()
+        out=func(*args,**kwargs)
+        self.stages[stage]=self.stages.get(stage,0.0)+time.perf_counter()-start
+        return out
+
+def run_stages(ext_path, fg_path, workdir, plot=True):
+    """Run the matching pipeline stage by stage
+    In: ext fpath, fg fpath, folder for outputs, whether to time plotting
+    Out: dict of stage -> seconds
+    """
+    timer=Timer()
+    full_ext_data=timer("load",lambda: next(read_ext(ext_path,EXT_COLS)))
+    full_ext_data[[EXT_COLS.ref,EXT_COLS.alt]]=full_ext_data[[EXT_COLS.ref,EXT_COLS.alt]].fillna(value="-")
+    missing_se=full_ext_data[EXT_COLS.se].isna().to_numpy()
+    full_ext_data.loc[missing_se,EXT_COLS.se]=timer("se_imputation",impute_se,
+        full_ext_data.loc[missing_se,EXT_COLS.beta].to_numpy(),full_ext_data.loc[missing_se,EXT_COLS.pval].to_numpy())
+
+    def harmonize_ext():
+        valid=valid_alleles(full_ext_data[EXT_COLS.ref]) & valid_alleles(full_ext_data[EXT_COLS.alt])
+        ext_data=full_ext_data[valid].copy()
+        invalid_ext_data=full_ext_data[~valid].copy()
+        invalid_ext_data["invalid_data"]="YES"
+        ext_data[EXT_COLS.ref]=ext_data[EXT_COLS.ref].str.upper()
+        ext_data[EXT_COLS.alt]=ext_data[EXT_COLS.alt].str.upper()
+        return (harmonize(ext_data,EXT_COLS.ref,EXT_COLS.alt,EXT_COLS.beta,UNIFIED_PREFIX),invalid_ext_data)
+    ext_data,invalid_ext_data=timer("harmonization",harmonize_ext)
+
+    def lookup():
+        tabix_handle,header,index=open_fg(fg_path,FG_COLS,MatchOptions("region"))
+        return lookup_fg(fg_path,tabix_handle,header,ext_data[EXT_COLS.chr],ext_data[EXT_COLS.pos],FG_COLS.chr,FG_COLS.pos,"region")
+    summary_data=timer("lookup",lookup).astype({FG_COLS.beta:float,FG_COLS.pval:float,FG_COLS.se:float})
+
+    def harmonize_fg():
+        data=summary_data[valid_alleles(summary_data[FG_COLS.ref]) & valid_alleles(summary_data[FG_COLS.alt])].copy()
+        return harmonize(data,FG_COLS.ref,FG_COLS.alt,FG_COLS.beta,UNIFIED_PREFIX)
+    fg_data=timer("harmonization",harmonize_fg)
+    matched=timer("merge",join_betas,ext_data,invalid_ext_data,fg_data,EXT_COLS,FG_COLS)
+
+    def stats():
+        stat_data=matched[["unif_beta_ext","unif_beta_fg",EXT_COLS.se+"_ext"]].dropna(axis="index",how="any")
+        calculate_r2(stat_data,"unif_beta_ext","unif_beta_fg",EXT_COLS.se+"_ext")
+        calculate_regression(stat_data["unif_beta_ext"].values,stat_data["unif_beta_fg"].values)
+        calculate_regression(stat_data["unif_beta_ext"].values,stat_data["unif_beta_fg"].values,1/(stat_data[EXT_COLS.se+"_ext"]**2))
+    timer("stats",stats)
+    out_path=os.path.join(workdir,"benchmark.betas.tsv")
+    timer("write",matched.to_csv,path_or_buf=out_path,index=False,sep="\t",na_rep="-")
+
+    if plot:
+        import corrplot
+        def plot_pdf():
+            plot_data=pd.read_csv(out_path,sep="\t",na_values="-")
+            p=corrplot.main(plot_data,"benchmark",["unif_beta_fg","unif_beta_ext"],[EXT_COLS.se+"_fg",EXT_COLS.se+"_ext"],"x","y",None,EXT_COLS.pval+"_ext",None)
+            corrplot.p9.save_as_pdf_pages([p],filename=os.path.join(workdir,"benchmark.pdf"))
+        timer("plot",plot_pdf)
+
+    def end_to_end():
+        process_ext_group(ext_path,[fg_path],EXT_COLS,FG_COLS,workdir,1.0,MatchOptions())
+    timer("end_to_end",end_to_end)
+    return timer.stages
+
+def compare(results, baseline, tolerance):
+    """Compare stage timings against a baseline
+    In: results, baseline results, allowed relative slowdown
+    Out: list of regressed stages
+    """
+    regressions=[]
+    print("{:<15}{:>12}{:>12}{:>9}".format("stage","baseline s","current s","ratio"))
+    for stage,seconds in results["stages"].items():
+        base=baseline["stages"].get(stage)
+        if base is None:
+            print("{:<15}{:>12}{:>12.4f}".format(stage,"-",seconds))
+            continue
+        ratio=seconds/base if base > 0 else float("inf")
+        flag=""
+        if ratio > 1+tolerance:
+            regressions.append(stage)
+            flag="  REGRESSION"
+        print("{:<15}{:>12.4f}{:>12.4f}{:>9.2f}{}".format(stage,base,seconds,ratio,flag))
+    return regressions
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Benchmark betamatch stages on synthetic data")
+    parser.add_argument("--fg-variants",type=int,default=200000,help="Number of variants in the synthetic finngen summary")
+    parser.add_argument("--ext-variants",type=int,default=20000,help="Number of variants in the synthetic external summary")
+    parser.add_argument("--repeats",type=int,default=3,help="Number of repeats. The fastest time of each stage is reported.")
+    parser.add_argument("--seed",type=int,default=1,help="Random seed for data generation")
+    parser.add_argument("--no-plot",action="store_true",help="Skip the plotting stage")
+    parser.add_argument("--workdir",default=None,help="Folder for generated data. A temporary folder is used by default.")
+    parser.add_argument("--out",default="benchmark.json",help="Output json file")
+    parser.add_argument("--baseline",default=None,help="Baseline json to compare against")
+    parser.add_argument("--tolerance",type=float,default=0.2,help="Allowed relative slowdown before a stage is reported as a regression")
+    args=parser.parse_args()
+
+    workdir=args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix="betamatch_bench_")
+    os.makedirs(workdir,exist_ok=True)
+    rng=random.Random(args.seed)
+    fg_path=os.path.join(workdir,"FG_BENCH.gz")
+    ext_path=os.path.join(workdir,"EXT_BENCH.tsv")
+    start=time.perf_counter()
+    fg_variants=generate_fg(fg_path,args.fg_variants,rng)
+    generate_ext(ext_path,fg_variants,args.ext_variants,rng)
+    print("Generated data in {} in {:.1f} s".format(workdir,time.perf_counter()-start))
+
+    stages=OrderedDict()
+    for _ in range(args.repeats):
+        for stage,seconds in run_stages(ext_path,fg_path,workdir,not args.no_plot).items():
+            stages[stage]=min(stages.get(stage,float("inf")),seconds)
+    results={"config":{"fg_variants":args.fg_variants,"ext_variants":args.ext_variants,"repeats":args.repeats,"seed":args.seed},
+        "machine":{"python":platform.python_version(),"platform":platform.platform(),"pandas":pd.__version__,"numpy":np.__version__},
+        "stages":stages}
+    with open(args.out,"w") as f:
+        json.dump(results,f,indent=2)
+    print("Wrote results to {}".format(args.out))
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline=json.load(f)
+        if baseline.get("config") != results["config"]:
+            print("Warning: baseline was run with a different configuration {}".format(baseline.get("config")))
+        regressions=compare(results,baseline,args.tolerance)
+        if regressions:
+            print("Stages slower than baseline: {}".format(", ".join(regressions)))
+            sys.exit(1)
+    else:
+        for stage,seconds in stages.items():
+            print("{:<15}{:>10.4f} s".format(stage,seconds))
@@ -0,0 +1,45 @@
+#! /usr/bin/env python3
+"""Benchmark startup time of betamatch and corrplot.
+
+Every command is run in a fresh interpreter, with lazy imports and with BETAMATCH_EAGER_IMPORTS=1,
+which loads all heavy modules up front like before lazy imports:
+
+    bench_import.py --repeats 5
+"""
+import argparse, json, os, subprocess, sys, time
+from collections import OrderedDict
+
+REPO=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMANDS=OrderedDict([
+    ("betamatch --help",[os.path.join(REPO,"betamatch.py"),"--help"]),
+    ("corrplot --help",[os.path.join(REPO,"corrplot.py"),"--help"]),
+    ("import betamatch",["-c","import betamatch"]),
+    ("import corrplot",["-c","import corrplot"]),
+])
+
+def run_time(args, eager):
+    """Wall time of one python run
+    In: python arguments, whether imports are eager
+    Out: seconds
+    """
+    env=dict(os.environ,PYTHONPATH=REPO)
+    env["BETAMATCH_EAGER_IMPORTS"]="1" if eager else "0"
+    start=time.perf_counter()
+    subprocess.run([sys.executable]+args,env=env,cwd=REPO,stdout=subprocess.DEVNULL,check=True)
+    return time.perf_counter()-start
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Benchmark startup time with lazy and eager imports")
+    parser.add_argument("--repeats",type=int,default=5,help="Number of repeats. The fastest time is reported.")
+    parser.add_argument("--out",default=None,help="Optional output json file")
+    args=parser.parse_args()
+    results=OrderedDict()
+    print("{:<20}{:>10}{:>10}{:>9}".format("command","eager s","lazy s","speedup"))
+    for name,command in COMMANDS.items():
+        eager=min(run_time(command,True) for _ in range(args.repeats))
+        lazy=min(run_time(command,False) for _ in range(args.repeats))
+        results[name]={"eager":eager,"lazy":lazy}
+        print("{:<20}{:>10.3f}{:>10.3f}{:>9.1f}".format(name,eager,lazy,eager/lazy))
+    if args.out is not None:
+        with open(args.out,"w") as f:
+            json.dump(results,f,indent=2)
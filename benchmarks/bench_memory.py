@@ -0,0 +1,66 @@
+#! /usr/bin/env python3
+"""Compare peak memory of betamatch with and without --compact on synthetic data.
+
+Both modes run in a fresh interpreter on the same data generated by bench_betamatch.py. The peak resident set size
+is taken from the run summary, and the matched tables of both modes are checked to be identical:
+
+    bench_memory.py --fg-variants 2000000 --ext-variants 1000000
+"""
+import argparse, filecmp, json, os, random, re, subprocess, sys, tempfile, time
+from collections import OrderedDict
+
+REPO=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,REPO)
+
+from bench_betamatch import generate_fg, generate_ext, EXT_COLS, FG_COLS
+
+MODES=OrderedDict([("default",[]),("compact",["--compact"])])
+
+def run_mode(workdir, match_file, mode, extra_args):
+    """Run betamatch in a fresh interpreter
+    In: folder for outputs, match file, mode name, extra command line arguments
+    Out: tuple of output folder, wall time in seconds and peak rss in MB
+    """
+    out_f=os.path.join(workdir,mode)
+    os.makedirs(out_f,exist_ok=True)
+    command=[sys.executable,os.path.join(REPO,"betamatch.py"),"--info-ext"]+list(EXT_COLS)+["--info-fg"]+list(FG_COLS)+[
+        "--match-file",match_file,"--output-folder",out_f,"--no-cache"]+extra_args
+    start=time.perf_counter()
+    log=subprocess.run(command,cwd=out_f,stdout=subprocess.PIPE,universal_newlines=True,check=True).stdout
+    seconds=time.perf_counter()-start
+    return (out_f,seconds,float(re.search(r"peak_rss_mb\s+([0-9.]+)",log).group(1)))
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Compare peak memory of betamatch with and without --compact")
+    parser.add_argument("--fg-variants",type=int,default=1000000,help="Number of variants in the synthetic finngen summary")
+    parser.add_argument("--ext-variants",type=int,default=500000,help="Number of variants in the synthetic external summary")
+    parser.add_argument("--seed",type=int,default=1,help="Random seed for data generation")
+    parser.add_argument("--workdir",default=None,help="Folder for generated data. A temporary folder is used by default.")
+    parser.add_argument("--out",default=None,help="Optional output json file")
+    args=parser.parse_args()
+
+    workdir=args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix="betamatch_mem_")
+    os.makedirs(workdir,exist_ok=True)
+    rng=random.Random(args.seed)
+    fg_path=os.path.join(workdir,"FG_BENCH.gz")
+    ext_path=os.path.join(workdir,"EXT_BENCH.tsv")
+    generate_ext(ext_path,generate_fg(fg_path,args.fg_variants,rng),args.ext_variants,rng)
+    match_file=os.path.join(workdir,"match.tsv")
+    with open(match_file,"w") as f:
+        f.write("{}\t{}\n".format(ext_path,fg_path))
+
+    results=OrderedDict()
+    print("{:<10}{:>10}{:>14}".format("mode","wall s","peak rss MB"))
+    for mode,extra_args in MODES.items():
+        out_f,seconds,peak=run_mode(workdir,match_file,mode,extra_args)
+        results[mode]={"seconds":seconds,"peak_rss_mb":peak}
+        print("{:<10}{:>10.2f}{:>14.1f}".format(mode,seconds,peak))
+    name="EXT_BENCHxFG_BENCH.betas.tsv"
+    same=filecmp.cmp(os.path.join(workdir,"default",name),os.path.join(workdir,"compact",name),shallow=False)
+    reduction=1-results["compact"]["peak_rss_mb"]/results["default"]["peak_rss_mb"]
+    print("Peak rss reduction {:.1%}, outputs {}".format(reduction,"identical" if same else "DIFFER"))
+    if args.out is not None:
+        with open(args.out,"w") as f:
+            json.dump({"config":vars(args),"modes":results,"identical":same},f,indent=2)
+    if not same:
+        sys.exit(1)
@@ -1,13 +1,14 @@
 #! /usr/bin/env python3
 
-from scipy.stats import pearsonr, norm
-import statsmodels.regression.linear_model as lm
-import numpy as np #type: ignore
-import pandas as pd #type: ignore
+from lazy import lazy_import
+scipy_stats=lazy_import("scipy.stats")
+np=lazy_import("numpy") #type: ignore
+pd=lazy_import("pandas") #type: ignore
 from typing import List, Dict, Tuple, Optional
 from collections import namedtuple
+import warnings
 
-def weighted_cov(x: np.array, y: np.array, w: np.array) -> float:
+def weighted_cov(x: "np.array", y: "np.array", w: "np.array") -> float:
     """Weighted covariance between vectors x and y, with weights w
     Args:
         x (np.array): numerical vector x
@@ -18,10 +19,215 @@ def weighted_cov(x: np.array, y: np.array, w: np.array) -> float:
     """
     return np.average( ( (x-np.average(x, weights=w) ) * (y - np.average(y, weights=w) ) ) , weights=w )
 
-def weighted_pearsonr(x: np.array, y: np.array, w: np.array) -> float:
+def weighted_pearsonr(x: "np.array", y: "np.array", w: "np.array") -> float:
     return weighted_cov(x, y, w) / np.sqrt( weighted_cov(x, x, w) * weighted_cov(y, y, w) )
 
-def calculate_r2(dataset: pd.DataFrame, x_label: str, y_label: str, stderr_label: str) -> Tuple[float, float, int, int]:
+def pval_to_zscore(pval: "np.array") -> "np.array":
+    """Absolute z-score of two-sided p-values
+    P-values below 1e-300 are converted in log space, as halving them would underflow.
+    Args:
+        pval (np.array): two-sided p-values
+    Returns:
+        (np.array): absolute z-scores
+    """
+    pval = np.asarray(pval, dtype=float)
+    zscore = scipy_stats.norm.isf(pval/2)
+    tiny = (pval > 0) & (pval < 1e-300)
+    if np.any(tiny):
+        # solve logsf(z) = log(p/2) with newton iterations
+        log_q = np.log(pval[tiny]) - np.log(2)
+        z = np.sqrt(-2*log_q)
+        for _ in range(20):
+            log_sf = scipy_stats.norm.logsf(z)
+            z = z + (log_sf - log_q)*np.exp(log_sf - scipy_stats.norm.logpdf(z))
+        zscore[tiny] = z
+    return zscore
+
+def impute_se(beta: "np.array", pval: "np.array") -> "np.array":
+    """Standard errors derived from beta and two-sided p-value
+    Args:
+        beta (np.array): effect sizes
+        pval (np.array): two-sided p-values
+    Returns:
+        (np.array): standard errors. Non-positive standard errors are returned as NaN.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        se = np.abs(np.asarray(beta, dtype=float))/pval_to_zscore(pval)
+    se[se <= 0] = np.nan
+    return se
+
+RegressionResults = namedtuple('RegressionResults',['slope', 'stderr', 'tstat', 'pval', 'rsquared'])
+GroupedStatistics = namedtuple('GroupedStatistics',['r2', 'weighted_r2', 'n', 'regression', 'weighted_regression'])
+
+def _group_sums(values: "np.array", groups: "np.array", n_groups: int) -> "np.array":
+    return np.bincount(groups, weights=values, minlength=n_groups)
+
+def _groups(x: "np.array", groups: Optional["np.array"], n_groups: Optional[int]) -> Tuple["np.array", int]:
+    if groups is None:
+        return (np.zeros(x.shape[0], dtype=np.intp), 1)
+    groups = np.asarray(groups, dtype=np.intp)
+    return (groups, n_groups if n_groups is not None else int(groups.max())+1 if groups.size else 0)
+
+def grouped_r2(x: "np.array", y: "np.array", w: Optional["np.array"] = None, groups: Optional["np.array"] = None, n_groups: Optional[int] = None) -> "np.array":
+    """Squared (weighted) pearson correlation of x and y for every group, from two passes of grouped sums
+    Args:
+        x (np.array): numerical vector x
+        y (np.array): numerical vector y
+        w (Optional[np.array]): weights, all ones by default
+        groups (Optional[np.array]): group index (0..n_groups-1) of every value. All values are in one group by default.
+        n_groups (Optional[int]): number of groups
+    Returns:
+        (np.array): r^2 of every group. NaN for groups with fewer than 2 values.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    w = np.ones_like(x) if w is None else np.broadcast_to(np.asarray(w, dtype=float), x.shape)
+    groups, n_groups = _groups(x, groups, n_groups)
+    n = np.bincount(groups, minlength=n_groups)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sum_w = _group_sums(w, groups, n_groups)
+        # centering before summing products avoids cancellation with large means
+        dx = x - (_group_sums(w*x, groups, n_groups)/sum_w)[groups]
+        dy = y - (_group_sums(w*y, groups, n_groups)/sum_w)[groups]
+        r = _group_sums(w*dx*dy, groups, n_groups)/np.sqrt(_group_sums(w*dx*dx, groups, n_groups)*_group_sums(w*dy*dy, groups, n_groups))
+    r = np.clip(r, -1.0, 1.0)
+    r[n < 2] = np.nan
+    return r**2
+
+def grouped_regression(x: "np.array", y: "np.array", w: Optional["np.array"] = None, groups: Optional["np.array"] = None, n_groups: Optional[int] = None) -> RegressionResults:
+    """Weighted least squares regression y=bx through the origin for every group, in closed form.
+    Gives the same results as statsmodels WLS without a constant.
+    Args:
+        x (np.array): numpy array of x-coordinates
+        y (np.array): numpy array of y-coordinates
+        w (Optional[np.array]): numpy array of point weights, all ones by default
+        groups (Optional[np.array]): group index (0..n_groups-1) of every point. All points are in one group by default.
+        n_groups (Optional[int]): number of groups
+    Returns:
+        (RegressionResults): Named tuple of arrays slope, stderr, t-statistic, pvalue, adjusted (uncentered) rsquared. All but slope are NaN for groups with fewer than 2 points.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    w = np.ones_like(x) if w is None else np.broadcast_to(np.asarray(w, dtype=float), x.shape)
+    groups, n_groups = _groups(x, groups, n_groups)
+    n = np.bincount(groups, minlength=n_groups)
+    df_resid = (n-1).astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sxx = _group_sums(w*x*x, groups, n_groups)
+        slope = _group_sums(w*x*y, groups, n_groups)/sxx
+        resid = y - slope[groups]*x
+        ssr = _group_sums(w*resid*resid, groups, n_groups)
+        stderr = np.sqrt(ssr/df_resid/sxx)
+        tstat = slope/stderr
+        pval = 2*scipy_stats.t.sf(np.abs(tstat), df_resid)
+        rsquared = 1 - ssr/_group_sums(w*y*y, groups, n_groups)
+        rsquared = 1 - n/df_resid*(1 - rsquared)
+    # a single point has no residual degrees of freedom
+    for values in (stderr, tstat, pval, rsquared):
+        values[n < 2] = np.nan
+    return RegressionResults(slope, stderr, tstat, pval, rsquared)
+
+def grouped_statistics(x: "np.array", y: "np.array", stderr: "np.array", groups: Optional["np.array"] = None, n_groups: Optional[int] = None) -> GroupedStatistics:
+    """R^2 and regressions y=bx, unweighted and weighted by inverse variance, for one or many pairs at once
+    Args:
+        x (np.array): numpy array of x-coordinates
+        y (np.array): numpy array of y-coordinates
+        stderr (np.array): standard errors of x, used for weights
+        groups (Optional[np.array]): pair index (0..n_groups-1) of every point. All points are in one pair by default.
+        n_groups (Optional[int]): number of pairs
+    Returns:
+        (GroupedStatistics): Named tuple of arrays r2, weighted_r2, n and RegressionResults of arrays regression, weighted_regression
+    """
+    stderr = np.asarray(stderr, dtype=float)
+    groups, n_groups = _groups(np.asarray(x), groups, n_groups)
+    return GroupedStatistics(grouped_r2(x, y, None, groups, n_groups),
+        grouped_r2(x, y, 1/(stderr**2 + 1e-9), groups, n_groups),
+        np.bincount(groups, minlength=n_groups),
+        grouped_regression(x, y, None, groups, n_groups),
+        grouped_regression(x, y, 1/stderr**2, groups, n_groups))
+
+ResampledStatistic = namedtuple('ResampledStatistic',['ci_low', 'ci_high', 'perm_pval'])
+BootstrapResults = namedtuple('BootstrapResults',['r2', 'weighted_r2', 'slope', 'weighted_slope'])
+
+# elements of the resampling matrices processed at once
+RESAMPLE_BLOCK = 1 << 22
+
+def _resample_blocks(n_resamples: int, n: int):
+    block = max(1, RESAMPLE_BLOCK//max(n, 1))
+    for start in range(0, n_resamples, block):
+        yield min(block, n_resamples-start)
+
+def _r2_from_sums(sums: "np.array") -> "np.array":
+    s_w, s_x, s_y, s_xx, s_yy, s_xy = sums.T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_x = s_x/s_w
+        mean_y = s_y/s_w
+        r = (s_xy/s_w - mean_x*mean_y)/np.sqrt((s_xx/s_w - mean_x*mean_x)*(s_yy/s_w - mean_y*mean_y))
+    return np.clip(r, -1.0, 1.0)**2
+
+def _resampled_statistics(sums: "np.array") -> "np.array":
+    """r^2, weighted r^2, slope and weighted slope of every row of moment sums"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.column_stack([_r2_from_sums(sums[:, 0:6]), _r2_from_sums(sums[:, 6:12]),
+            sums[:, 12]/sums[:, 13], sums[:, 14]/sums[:, 15]])
+
+def bootstrap_statistics(x: "np.array", y: "np.array", stderr: "np.array", n_resamples: int, rng: "np.random.Generator", ci: float = 0.95) -> BootstrapResults:
+    """Bootstrap confidence intervals and permutation p-values of the statistics of grouped_statistics for one pair.
+    Every statistic is a function of sums of per-point moments, so a block of resamples is one matrix product of the bootstrap
+    counts with the moment matrix, and a block of permutations one product of the permuted y values with it.
+    Args:
+        x (np.array): numpy array of x-coordinates
+        y (np.array): numpy array of y-coordinates
+        stderr (np.array): standard errors of x, used for weights
+        n_resamples (int): number of bootstrap resamples, and of permutations of y
+        rng (np.random.Generator): random generator
+        ci (float): confidence level of the percentile intervals
+    Returns:
+        (BootstrapResults): Named tuple of ResampledStatistic (ci_low, ci_high, perm_pval) for r2, weighted_r2, slope and weighted_slope.
+            p-values are two-sided for slopes. All values are NaN with fewer than 2 points.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    stderr = np.asarray(stderr, dtype=float)
+    n = x.shape[0]
+    if n < 2 or n_resamples < 1:
+        return BootstrapResults(*[ResampledStatistic(np.nan, np.nan, np.nan)]*4)
+    w_r2 = 1/(stderr**2 + 1e-9)
+    with np.errstate(divide="ignore"):
+        w_reg = 1/stderr**2
+    # r^2 does not depend on location, so its moments are taken around the means to avoid cancellation
+    xc = x - x.mean()
+    yc = y - y.mean()
+    moments = np.column_stack([np.ones(n), xc, yc, xc*xc, yc*yc, xc*yc,
+        w_r2, w_r2*xc, w_r2*yc, w_r2*xc*xc, w_r2*yc*yc, w_r2*xc*yc,
+        x*y, x*x, w_reg*x*y, w_reg*x*x])
+    total = moments.sum(axis=0)
+    observed = _resampled_statistics(total[None, :])[0]
+    # permuting y only changes the sums of terms with both x and y, or with y and a weight of x
+    perm_weights = np.column_stack([xc, w_r2, w_r2*xc, x, w_reg*x])
+    boot = []
+    exceed = np.zeros(4)
+    for size in _resample_blocks(n_resamples, n):
+        draws = rng.integers(0, n, size=(size, n)) + n*np.arange(size)[:, None]
+        counts = np.bincount(draws.ravel(), minlength=size*n).reshape(size, n)
+        boot.append(_resampled_statistics(counts @ moments))
+        perm = np.argsort(rng.random((size, n)), axis=1)
+        sums = np.tile(total, (size, 1))
+        sums[:, [5, 8, 11]] = yc[perm] @ perm_weights[:, [0, 1, 2]]
+        sums[:, 10] = (yc*yc)[perm] @ w_r2
+        sums[:, [12, 14]] = y[perm] @ perm_weights[:, [3, 4]]
+        permuted = _resampled_statistics(sums)
+        exceed[:2] += np.sum(permuted[:, :2] >= observed[:2], axis=0)
+        exceed[2:] += np.sum(np.abs(permuted[:, 2:]) >= np.abs(observed[2:]), axis=0)
+    with warnings.catch_warnings():
+        # resamples without variance give NaN and are left out
+        warnings.simplefilter("ignore", RuntimeWarning)
+        low, high = np.nanquantile(np.concatenate(boot), [(1-ci)/2, 1-(1-ci)/2], axis=0)
+    pval = (1 + exceed)/(1 + n_resamples)
+    pval[np.isnan(observed)] = np.nan
+    return BootstrapResults(*[ResampledStatistic(low[i], high[i], pval[i]) for i in range(4)])
+
+def calculate_r2(dataset: "pd.DataFrame", x_label: str, y_label: str, stderr_label: str) -> Tuple[float, float, int, int]:
     """Calculate r2 values for dataset
     Args:
         dataset (pd.DataFrame): dataset
@@ -40,43 +246,26 @@ def calculate_r2(dataset: pd.DataFrame, x_label: str, y_label: str, stderr_label
     N_r=np.nan
     N_w=np.nan
     if data_r2.shape[0]>= 2:
-        x_array = data_r2[x_label].values
-        y_array = data_r2[y_label].values
-        r,_=pearsonr(x_array,y_array)
-        r_2=r**2
+        r_2=grouped_r2(data_r2[x_label].values,data_r2[y_label].values)[0]
         N_r=data_r2.shape[0]
     if data_w.shape[0]>=2:
-        x_array = data_w[x_label].values
-        y_array = data_w[y_label].values
         stderr = data_w[stderr_label].values
         weight_array= 1/(stderr**2 + 1e-9) #weights as inverse of variance 
-        r_w=weighted_pearsonr(x_array,y_array,weight_array)
-        r_w=r_w**2
+        r_w=grouped_r2(data_w[x_label].values,data_w[y_label].values,weight_array)[0]
         N_w=data_w.shape[0]
     return (r_2,r_w,N_r,N_w)
 
-
-RegressionResults = namedtuple('RegressionResults',['slope', 'stderr', 'tstat', 'pval', 'rsquared'])
-
-def calculate_regression(x: np.array,
-                        y: np.array,
-                        weights: Optional[np.array] = None)-> RegressionResults :
+def calculate_regression(x: "np.array",
+                        y: "np.array",
+                        weights: Optional["np.array"] = None)-> RegressionResults :
     """Calculate regression y=bx coefficients from data.
-    Model uses statsmodels.regression.linear_model.WLS.
+    Model is weighted least squares without a constant, see grouped_regression.
     Args:
         x (np.array): numpy array of x-coordinates
         y (np.array): numpy array of y-coordinates
-        weights (Optional[np.array]): numpy array of point weights. These are passed directly to WSL.
+        weights (Optional[np.array]): numpy array of point weights.
     Returns:
         (RegressionResults): Named tuple with variables slope, stderr, t-statistic, pvalue, rsquared
     """
-    weights = weights if type(weights) != type(None) else 1.0
-    model = lm.WLS(y,x,weights)
-    results = model.fit()
-    slope=results.params[0]
-    stderr = results.bse[0]
-    tstat = results.tvalues[0]
-    pval = results.pvalues[0]
-    rsquared = results.rsquared_adj
-
-    return RegressionResults(slope, stderr, tstat, pval,rsquared)
\ No newline at end of file
+    results = grouped_regression(x, y, weights)
+    return RegressionResults(*(value[0] for value in results))
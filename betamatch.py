@@ -1,13 +1,22 @@
 #! /usr/bin/python3
-from typing import NamedTuple
-import pandas as pd, numpy as np
+from typing import NamedTuple, Optional, List, Tuple, Dict
 import tabix
-import argparse
-import os,subprocess,glob,shlex,re
-from subprocess import Popen,PIPE
-from scipy.stats import pearsonr, norm
+import argparse,sys
+import os,glob,gzip,re,shutil,tempfile,time,traceback,zlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from collections import OrderedDict
 
-from beta_utils import *
+from lazy import lazy_import
+from beta_utils import impute_se, grouped_statistics, bootstrap_statistics
+from harmonize import harmonize, valid_alleles, flip_beta, encode_alleles
+from fg_lookup import lookup_fg, LOOKUP_STRATEGIES, STREAM_THRESHOLD
+from fg_index import build_index, open_index, index_path_for
+from table_formats import OUTPUT_FORMATS, DEFAULT_COMPRESS_LEVEL, table_suffix, open_writer, spool_writer, index_table
+from result_cache import ResultCache, default_cache_dir
+from metrics import timed, timed_iter, count, write_metrics, summarize, peak_rss_mb
+pd=lazy_import("pandas")
+np=lazy_import("numpy")
 
 class FGCols(NamedTuple):
     chr:str
@@ -18,6 +27,16 @@ class FGCols(NamedTuple):
     pval:str
     se:str
 
+class MatchOptions(NamedTuple):
+    lookup:str="auto"
+    index_dir:Optional[str]=None
+    chunk_size:Optional[int]=None
+    output_format:str="tsv"
+    compact:bool=False
+    bootstrap:int=0
+    seed:int=0
+    compress_level:int=DEFAULT_COMPRESS_LEVEL
+
 class ExtCols(NamedTuple):
     chr:str
     pos:str
@@ -28,141 +47,291 @@ class ExtCols(NamedTuple):
     se:str
     study_doi:str
 
-def flip_unified_strand(a1,a2):
-    """
-    Flips alleles to the A strand if necessary 
-    """
-    allele_dict={"T":"A","C":"G","G":"C"}
-     # check if the A variant is present
-    if 'A' not in a1 + a2 and 'a' not in a1+a2:
-        # for both/ref and alt map them to the A strand and order each one lexicographically
-        a1 = ''.join([allele_dict[elem.upper()] for elem in a1])
-        a2 = ''.join([allele_dict[elem.upper()] for elem in a2])
-    return (a1,a2)
-
-def flip_beta(r1,a1,beta1,beta2):
-    """If beta1 <0, flip betas (and consequently alleles)
-    """
-    if beta1 < 0:
-        return (a1,r1,-beta1,-beta2)
-    else:
-        return (r1,a1,beta1,beta2)
+#headers of gzipped files, read once per path
+_header_cache={}
 
 def get_gzip_header(fname):
-    """"Returns header for gzipped tsvs, as that is not currently possible using pytabix
+    """"Returns header for gzipped tsvs, as that is not currently possible using pytabix.
+    Only the first line is decompressed, and headers are cached per path.
     In: file path of gzipped tsv
     Out: header of tsv as a list of column names"""
-    gzip_call=shlex.split("gzip -cd {}".format(fname))
-    head_call=shlex.split("head -n 1")
-    out=[]
-    with Popen(gzip_call,stdout=PIPE) as gz:
-        with Popen(head_call,stdin=gz.stdout,stdout=PIPE) as hd:
-            for line in hd.stdout:
-                out.append(line.decode().strip().split("\t"))
-    return out[0]
+    if fname not in _header_cache:
+        with gzip.open(fname,"rt") as f:
+            _header_cache[fname]=f.readline().strip().split("\t")
+    return list(_header_cache[fname])
 
-def pytabix(tb,chrom,start,end):
-    """Get genomic region from tabixed file
-    In: pytabix handle, chromosome, start of region, end of region
-    Out: list of variants in region 
+def check_fg_columns(fg_summary, info_fg:FGCols):
+    """
+    Check that all finngen columns exist in the header of a finngen file
+    In: fg fpath, column tuple
+    Out: None. Raises ValueError if columns are missing.
     """
-    try:
-        retval=tb.querys("{}:{}-{}".format(chrom,start,end))
-        return list(retval)
-    except tabix.TabixError:
-        return []
+    header=get_gzip_header(fg_summary)
+    missing=[col for col in info_fg if col not in header]
+    if missing:
+        raise ValueError("Columns {} given in --info-fg not found in the header of finngen file {}. Header columns: {}".format(
+            ", ".join(missing),fg_summary,", ".join(header)))
+
+UNIFIED_PREFIX="unif_"
 
+def ext_dtypes(info_ext:ExtCols):
+    """Column types for external summary files"""
+    return {info_ext.chr:object,
+            info_ext.pos:object,
+            info_ext.ref:object,
+            info_ext.alt:object,
+            info_ext.beta:float,
+            info_ext.pval:float,
+            info_ext.se:float,
+            info_ext.study_doi:object}
 
-def match_beta(ext_path, fg_summary, info_ext:ExtCols, info_fg:FGCols):
+def fg_dtypes(info_fg:FGCols):
+    """Column types for finngen summary files"""
+    return {info_fg.chr:object,
+            info_fg.pos:object,
+            info_fg.ref:object,
+            info_fg.alt:object,
+            info_fg.beta:float,
+            info_fg.pval:float,
+            info_fg.se:float}
+
+#largest position stored as int32 in compact mode
+MAX_COMPACT_POS=2**31-1
+
+def canonical_positions(positions):
     """
-    Match beta for external summary variants and our variants
-    In: ext fpath, fg fpath, column tuple
-    Out: df containing the results. DOES NOT SAVE FILES
+    Parse positions written as plain integers
+    In: position column
+    Out: tuple of int64 positions and mask of positions that are plain integers, i.e. that are written back unchanged
     """
-    unified_prefix="unif_"
-    ext_dtype = {info_ext.chr:object,
-                info_ext.pos:object,
-                info_ext.ref:object,
-                info_ext.alt:object,
-                info_ext.beta:float,
-                info_ext.pval:float,                
-                info_ext.se:float,
-                info_ext.study_doi:object}
-    fg_dtype = {info_fg.chr:object,
-                info_fg.pos:object,
-                info_fg.ref:object,
-                info_fg.alt:object,
-                info_fg.beta:float,
-                info_fg.pval:float,
-                info_fg.se:float}
-    full_ext_data= pd.read_csv(ext_path,sep="\t",dtype=ext_dtype)
+    if pd.api.types.is_integer_dtype(positions.dtype):
+        values=positions.to_numpy(dtype=np.int64)
+        return (values,values >= 0)
+    parsed=pd.to_numeric(positions,errors="coerce")
+    ok=np.array(parsed.notna() & (parsed <= MAX_COMPACT_POS) & positions.str.isdigit().fillna(False),dtype=bool)
+    values=np.zeros(positions.size,dtype=np.int64)
+    values[ok]=parsed.to_numpy()[ok].astype(np.int64)
+    #digits only and no leading zeros
+    n_digits=np.searchsorted(10**np.arange(1,11,dtype=np.int64),values,side="right")+1
+    ok&=np.array(positions.str.len().fillna(0),dtype=np.int64) == n_digits
+    return (values,ok)
+
+def compact_frame(data, chr_col, pos_col):
+    """
+    Store chromosomes as categories and positions as int32. Positions stay strings if any of them is not a plain integer that fits in int32.
+    In: dataframe, chromosome column name, position column name
+    Out: dataframe
+    """
+    data[chr_col]=data[chr_col].astype("category")
+    values,ok=canonical_positions(data[pos_col])
+    if ok.all() and (values <= MAX_COMPACT_POS).all():
+        data[pos_col]=values.astype(np.int32)
+    return data
+
+def read_ext(ext_path, info_ext:ExtCols, chunk_size=None, compact=False):
+    """
+    Read external summary, either whole or in chunks.
+    In compact mode only the columns that end up in the output are read, and chromosomes and positions are stored compactly.
+    In: ext fpath, column tuple, number of rows per chunk (None to read the whole file), whether to use compact mode
+    Out: iterator of dataframes
+    """
+    usecols=None
+    if compact:
+        wanted=set(info_ext) | {"trait"}
+        usecols=lambda col: col in wanted
+    chunks=pd.read_csv(ext_path,sep="\t",dtype=ext_dtypes(info_ext),usecols=usecols,chunksize=chunk_size)
+    if chunk_size is None:
+        chunks=[chunks]
+    for chunk in chunks:
+        yield compact_frame(chunk,info_ext.chr,info_ext.pos) if compact else chunk
+
+def prepare_ext(full_ext_data, info_ext:ExtCols, stats=None):
+    """
+    Impute missing standard errors, validate and harmonize alleles of external summary variants
+    In: external summary dataframe, column tuple, optional dict that is filled with counts
+    Out: tuple of harmonized valid variants and variants with invalid alleles
+    """
+    count(stats,"ext_rows",full_ext_data.shape[0])
     full_ext_data[[info_ext.ref,info_ext.alt]]=full_ext_data[[info_ext.ref,info_ext.alt]].fillna(value="-")
 
     full_ext_data[info_ext.pval]=full_ext_data[info_ext.pval].astype(float)
     full_ext_data[info_ext.beta]=full_ext_data[info_ext.beta].astype(float)
     #replace missing se values with values derived from beta+pvalue
-    for idx,row in full_ext_data.iterrows():
-        if pd.isna(row[info_ext.se]):
-            #calculate se
-            zscore=np.abs(norm.ppf(row[info_ext.pval]/2) )
-            se=np.abs(row[info_ext.beta])/zscore
-            full_ext_data.loc[idx,info_ext.se] = np.nan if se <= 0 else se
-    full_ext_data[info_ext.se]=full_ext_data[info_ext.se].astype(float)
-    mset='^[acgtACGT]+$'
-    matchset1=full_ext_data[info_ext.ref].apply(lambda x:bool(re.match(mset,x)))
-    matchset2=full_ext_data[info_ext.alt].apply(lambda x:bool(re.match(mset,x)))
-    ext_data=full_ext_data[matchset1 & matchset2].copy()
-    invalid_ext_data=full_ext_data[~(matchset1 & matchset2)].copy()
-    invalid_ext_data["invalid_data"]="YES"
-    ext_data[info_ext.ref]=ext_data[info_ext.ref].apply(lambda x:x.upper())
-    ext_data[info_ext.alt]=ext_data[info_ext.alt].apply(lambda x:x.upper())
-   
-    #load corresponding data from fg file using tabix
-    if not os.path.exists("{}.tbi".format(fg_summary)):
-        raise FileNotFoundError("Tabix index for file {} not found. Make sure that the file is properly indexed.".format(fg_summary))
-    try:
-        tabix_handle = tabix.open(fg_summary)
-    except tabix.TabixError as e:
-        print("An error occurred when opening file {}. Make sure that the file exists and that it is correctly indexed.".format(fg_summary))
-        raise
-    tmp_lst=[]
-    for _,row in ext_data.iterrows():
-        tmp_lst=tmp_lst+pytabix(tabix_handle,row[info_ext.chr],row[info_ext.pos],row[info_ext.pos] )
-    header=get_gzip_header(fg_summary)
+    with timed(stats,"se_imputation"):
+        full_ext_data[info_ext.se]=full_ext_data[info_ext.se].astype(float)
+        missing_se=full_ext_data[info_ext.se].isna().to_numpy()
+        full_ext_data.loc[missing_se,info_ext.se]=impute_se(full_ext_data.loc[missing_se,info_ext.beta].to_numpy(),
+            full_ext_data.loc[missing_se,info_ext.pval].to_numpy())
+    count(stats,"se_imputed",np.count_nonzero(missing_se))
+    with timed(stats,"ext_harmonization"):
+        valid=valid_alleles(full_ext_data[info_ext.ref]) & valid_alleles(full_ext_data[info_ext.alt])
+        ext_data=full_ext_data[valid].copy()
+        invalid_ext_data=full_ext_data[~valid].copy()
+        invalid_ext_data["invalid_data"]="YES"
+        ext_data[info_ext.ref]=ext_data[info_ext.ref].str.upper()
+        ext_data[info_ext.alt]=ext_data[info_ext.alt].str.upper()
+        ext_data[info_ext.beta]=pd.to_numeric(ext_data[info_ext.beta],errors='coerce')
+        ext_data=harmonize(ext_data,info_ext.ref,info_ext.alt,info_ext.beta,UNIFIED_PREFIX)
+    count(stats,"invalid_alleles",invalid_ext_data.shape[0])
+    return (ext_data,invalid_ext_data)
+
+def load_ext(ext_path, info_ext:ExtCols, stats=None):
+    """
+    Load external summary, impute missing standard errors and harmonize alleles
+    In: ext fpath, column tuple, optional dict that is filled with counts
+    Out: tuple of harmonized valid variants and variants with invalid alleles
+    """
+    return prepare_ext(next(read_ext(ext_path,info_ext)),info_ext,stats)
+
+#open tabix handles, headers and binary indexes of the most recently used fg files. Every tabix handle holds a file
+#descriptor and every index maps its files, so only FG_SOURCES files are kept open and the least recently used is closed.
+_fg_sources=OrderedDict()
+FG_SOURCES=32
+
+def open_fg(fg_summary, info_fg:FGCols, options:MatchOptions=MatchOptions(), stats=None):
+    """
+    Open fg file for lookups. Handles, headers and indexes are cached per file path for the FG_SOURCES most recently used files.
+    In: fg fpath, column tuple, match options, optional dict that is filled with counts
+    Out: tuple of pytabix handle, header and binary index. Only the ones needed by the lookup strategy are opened, others are None.
+    """
+    if fg_summary in _fg_sources:
+        _fg_sources.move_to_end(fg_summary)
+    else:
+        while len(_fg_sources) >= FG_SOURCES:
+            #pytabix handles and memory maps are closed when they are no longer referenced
+            _drop_scan(_fg_sources.popitem(last=False)[1])
+        _fg_sources[fg_summary]={}
+        count(stats,"fg_opens",1)
+    source=_fg_sources[fg_summary]
+    if options.lookup in ("auto","index"):
+        if "index" not in source:
+            source["index"]=open_index(fg_summary,list(info_fg),options.index_dir)
+        if source["index"] is not None:
+            return (None,None,source["index"])
+    if "header" not in source:
+        source["header"]=get_gzip_header(fg_summary)
+    if source.get("tabix") is None and options.lookup in ("auto","region"):
+        if not os.path.exists("{}.tbi".format(fg_summary)):
+            raise FileNotFoundError("Tabix index for file {} not found. Make sure that the file is properly indexed.".format(fg_summary))
+        try:
+            source["tabix"] = tabix.open(fg_summary)
+        except tabix.TabixError as e:
+            print("An error occurred when opening file {}. Make sure that the file exists and that it is correctly indexed.".format(fg_summary))
+            raise
+    return (source.get("tabix"),source["header"],None)
 
-    summary_data=pd.DataFrame(tmp_lst,columns=header).astype(dtype=fg_dtype)
-    ext_data[info_ext.beta]=pd.to_numeric(ext_data[info_ext.beta],errors='coerce')
-    summary_data[info_fg.beta]=pd.to_numeric(summary_data[info_fg.beta])
-    #filter out invalid variants from summaries
-    matchset1=summary_data[info_fg.ref].apply(lambda x:bool(re.match(mset,x)))
-    matchset2=summary_data[info_fg.alt].apply(lambda x:bool(re.match(mset,x)))
-    summary_data=summary_data[matchset1 & matchset2]
-
-    unif_alt="{}alt".format(unified_prefix)
-    unif_ref="{}ref".format(unified_prefix)
-    summary_data[[unif_ref,unif_alt]]=summary_data.loc[:,[ info_fg.ref, info_fg.alt ]].apply(lambda x: flip_unified_strand(*x),axis=1,result_type="expand")
-    ext_data[[unif_ref,unif_alt]]=ext_data.loc[:,[ info_ext.ref, info_ext.alt ]].apply(lambda x: flip_unified_strand(*x),axis=1,result_type="expand")
-    unif_beta="{}beta".format(unified_prefix)
-    summary_data[unif_beta]=summary_data[info_fg.beta]
-    ext_data[unif_beta]=ext_data[info_ext.beta]
-
-    summary_data["sort_dir"] = summary_data[[unif_ref,unif_alt]].apply(lambda x: -1 if (sorted(list(x) ) != list(x)) else 1,axis=1)
-    summary_data[[unif_ref,unif_alt]]=summary_data[[unif_ref,unif_alt]].apply(lambda x: sorted(list(x)),axis=1,result_type="expand")
-    summary_data[unif_beta]=summary_data["sort_dir"]*summary_data[unif_beta]
-    summary_data=summary_data.drop(labels="sort_dir",axis="columns")
-    ext_data["sort_dir"] = ext_data[[unif_ref,unif_alt]].apply(lambda x: -1 if (sorted(list(x)) != list(x)) else 1,axis=1)
-    ext_data[[unif_ref,unif_alt]]=ext_data[[unif_ref,unif_alt]].apply(lambda x: sorted(list(x)),axis=1,result_type="expand")
-    ext_data[unif_beta]=ext_data["sort_dir"]*ext_data[unif_beta]
-    ext_data=ext_data.drop(labels="sort_dir",axis="columns")
+def _drop_scan(source):
+    """Remove the temporary index of an fg source and restart its count of looked up variants"""
+    source.pop("scan",None)
+    source.pop("looked_up",None)
+    scan_dir=source.pop("scan_dir",None)
+    if scan_dir is not None:
+        shutil.rmtree(scan_dir,ignore_errors=True)
+
+def release_fg(fg_paths):
+    """
+    Remove the temporary indexes of fg sources once their pairs are matched. Tabix handles and headers stay open for later pairs.
+    In: list of fg fpaths
+    """
+    for fg_path in fg_paths:
+        if fg_path in _fg_sources:
+            _drop_scan(_fg_sources[fg_path])
+
+def scan_index(fg_summary, info_fg:FGCols, n_variants):
+    """
+    Temporary binary index of an fg file for the auto strategy in chunked mode. Once the chunks matched against the file
+    have asked for more than STREAM_THRESHOLD variants, the file is read once into an index that serves the following chunks,
+    instead of a streaming pass for every chunk.
+    In: fg fpath, column tuple, number of variants in the current chunk
+    Out: FGIndex, or None while region queries are cheaper
+    """
+    source=_fg_sources[fg_summary]
+    if "scan" not in source:
+        source["looked_up"]=source.get("looked_up",0)+n_variants
+        if source["looked_up"] <= STREAM_THRESHOLD:
+            return None
+        source["scan_dir"]=tempfile.mkdtemp(prefix="betamatch_scan_")
+        build_index(fg_summary,list(info_fg),index_path_for(fg_summary,source["scan_dir"]))
+        source["scan"]=open_index(fg_summary,list(info_fg),source["scan_dir"])
+    return source["scan"]
+
+def load_fg(fg_summary, ext_data, info_ext:ExtCols, info_fg:FGCols, options:MatchOptions=MatchOptions(), stats=None):
+    """
+    Load fg variants at the positions of the external variants and harmonize alleles.
+    With options.chunk_size set, the auto strategy never streams, as a streaming pass would read the whole fg file again for every chunk.
+    Chunks use region queries until a temporary index of the fg file is cheaper, see scan_index.
+    In: fg fpath, harmonized external variants, column tuples, match options, optional dict that is filled with counts
+    Out: harmonized fg variants
+    """
+    with timed(stats,"lookup"):
+        tabix_handle,header,index=open_fg(fg_summary,info_fg,options,stats)
+        if index is None and options.lookup == "auto" and options.chunk_size is not None:
+            index=scan_index(fg_summary,info_fg,ext_data.shape[0])
+        stream_threshold=STREAM_THRESHOLD if options.chunk_size is None else None
+        #in compact mode only the used columns are kept, and rows are typed batch by batch as they are read
+        fields,convert=(list(info_fg),lambda part: compact_frame(part.astype(dtype=fg_dtypes(info_fg)),info_fg.chr,info_fg.pos)) if options.compact else (None,None)
+        summary_data=lookup_fg(fg_summary,tabix_handle,header,ext_data[info_ext.chr],ext_data[info_ext.pos],info_fg.chr,info_fg.pos,options.lookup,index,stats,stream_threshold,fields,convert)
+    count(stats,"fg_rows",summary_data.shape[0])
+    with timed(stats,"fg_harmonization"):
+        if options.compact:
+            if summary_data[info_fg.pos].dtype == object:
+                #batches with int32 positions were concatenated with batches of other positions, which stay text
+                summary_data[info_fg.pos]=np.array([str(p) for p in summary_data[info_fg.pos]],dtype=object)
+            summary_data=compact_frame(summary_data,info_fg.chr,info_fg.pos)
+        else:
+            summary_data=summary_data.astype(dtype=fg_dtypes(info_fg))
+        summary_data[info_fg.beta]=pd.to_numeric(summary_data[info_fg.beta])
+        #filter out invalid variants from summaries
+        summary_data=summary_data[valid_alleles(summary_data[info_fg.ref]) & valid_alleles(summary_data[info_fg.alt])].copy()
+        return harmonize(summary_data,info_fg.ref,info_fg.alt,info_fg.beta,UNIFIED_PREFIX)
+
+def variant_keys(ext_chr, ext_pos, fg_chr, fg_pos):
+    """
+    Encode chromosome and position pairs as int64 keys that are equal exactly when the pairs are equal
+    In: external chromosome column, external position column, fg chromosome column, fg position column
+    Out: tuple of external and fg key arrays
+    """
+    n_ext=ext_chr.size
+    chroms=pd.factorize(np.concatenate([ext_chr.to_numpy(dtype=object),fg_chr.to_numpy(dtype=object)]))[0].astype(np.int64)
+    ext_values,ext_ok=canonical_positions(ext_pos)
+    fg_values,fg_ok=canonical_positions(fg_pos)
+    positions=np.concatenate([ext_values,fg_values])
+    ok=np.concatenate([ext_ok,fg_ok]) & (chroms >= 0)
+    keys=(chroms << 32) | positions
+    #other positions are compared as text, like without compact mode
+    if not ok.all():
+        all_chr=np.concatenate([ext_chr.to_numpy(dtype=object),fg_chr.to_numpy(dtype=object)])[~ok]
+        all_pos=np.concatenate([ext_pos.to_numpy(dtype=object),fg_pos.to_numpy(dtype=object)])[~ok]
+        keys[~ok]=-1-pd.factorize(np.array(["{}:{}".format(c,p) for c,p in zip(all_chr,all_pos)],dtype=object))[0]
+    return (keys[:n_ext],keys[n_ext:])
+
+def join_betas(ext_data, invalid_ext_data, summary_data, info_ext:ExtCols, info_fg:FGCols, compact=False):
+    """
+    Join harmonized external and fg variants.
+    In compact mode variants are joined on integer keys of the position and unified alleles instead of on the text columns.
+    In: harmonized external variants, invalid external variants, harmonized fg variants, column tuples, whether to use compact mode
+    Out: df containing the results
+    """
+    unif_alt="{}alt".format(UNIFIED_PREFIX)
+    unif_ref="{}ref".format(UNIFIED_PREFIX)
+    unif_beta="{}beta".format(UNIFIED_PREFIX)
     ext_data=pd.concat([ext_data,invalid_ext_data],sort=False)
     info_fg_rename = {info_fg[i]:info_ext[i] for i in range(len(info_ext)-1)} 
-    summary_data.rename(columns=info_fg_rename, inplace=True)
-    joined_data=pd.merge(ext_data, summary_data,how="left", on=[info_ext[0],info_ext[1],unif_alt,unif_ref],suffixes=("_ext","_fg"))
+    summary_data=summary_data.rename(columns=info_fg_rename)
+    if compact:
+        keys=["_variant_key","_ref_key","_alt_key"]
+        ext_data[keys[0]],summary_data[keys[0]]=variant_keys(ext_data[info_ext.chr],ext_data[info_ext.pos],summary_data[info_ext.chr],summary_data[info_ext.pos])
+        ext_data[keys[1]],summary_data[keys[1]]=encode_alleles(ext_data[unif_ref],summary_data[unif_ref])
+        ext_data[keys[2]],summary_data[keys[2]]=encode_alleles(ext_data[unif_alt],summary_data[unif_alt])
+        summary_data=summary_data.drop(columns=[info_ext.chr,info_ext.pos,unif_ref,unif_alt])
+        joined_data=pd.merge(ext_data, summary_data,how="left", on=keys,suffixes=("_ext","_fg")).drop(columns=keys)
+    else:
+        joined_data=pd.merge(ext_data, summary_data,how="left", on=[info_ext[0],info_ext[1],unif_alt,unif_ref],suffixes=("_ext","_fg"))
 
     unif_beta_ext="{}_ext".format(unif_beta)
     unif_beta_fg="{}_fg".format(unif_beta)
-    joined_data[[unif_ref,unif_alt,unif_beta_ext,unif_beta_fg]]=joined_data[[unif_ref,unif_alt,unif_beta_ext,unif_beta_fg]].apply(
-        lambda x: flip_beta(*x),axis=1,result_type="expand")
+    (joined_data[unif_ref],joined_data[unif_alt],joined_data[unif_beta_ext],joined_data[unif_beta_fg])=flip_beta(
+        joined_data[unif_ref],joined_data[unif_alt],joined_data[unif_beta_ext],joined_data[unif_beta_fg])
     
     joined_data["beta_same_direction"]=(joined_data["{}_ext".format(unif_beta) ]*joined_data["{}_fg".format(unif_beta) ])>=0
     if "trait" not in joined_data.columns:
@@ -180,6 +349,16 @@ def match_beta(ext_path, fg_summary, info_ext:ExtCols, info_fg:FGCols):
     joined_data=joined_data[field_order]
     return joined_data
 
+def match_beta(ext_path, fg_summary, info_ext:ExtCols, info_fg:FGCols, stats=None, options:MatchOptions=MatchOptions()):
+    """
+    Match beta for external summary variants and our variants
+    In: ext fpath, fg fpath, column tuple, optional dict that is filled with counts, match options
+    Out: df containing the results. DOES NOT SAVE FILES
+    """
+    ext_data,invalid_ext_data=load_ext(ext_path,info_ext,stats)
+    summary_data=load_fg(fg_summary,ext_data,info_ext,info_fg,options,stats)
+    return join_betas(ext_data,invalid_ext_data,summary_data,info_ext,info_fg,options.compact)
+
 def extract_doi(joined_data, info):
     """
     Output doi strings
@@ -189,52 +368,619 @@ def extract_doi(joined_data, info):
     doi_concat=','.join(joined_data[info].dropna().unique())
     return doi_concat
 
-def main(info_ext:ExtCols,info_fg:FGCols,match_file,out_f,pval_filter):
+def pair_output_name(ext_path, fg_path, output_format="tsv"):
+    """
+    Output file name for a match file pair
+    In: ext fpath, fg fpath, output format
+    Out: file name of matched betas
+    """
+    fg_name = os.path.splitext(os.path.basename(fg_path))[0]
+    ext_name = os.path.splitext(os.path.basename(ext_path))[0]
+    return "{}x{}{}".format(ext_name.split(".")[0],fg_name,table_suffix(output_format))
+
+class PairOutput:
+    """
+    Matched betas of one pair. Rows are appended to the output file as they are matched,
+    and only the columns needed for statistics are kept in memory.
+    Rows with invalid alleles are written after all other rows, like in the unchunked output.
+    """
+    def __init__(self, out_f, output_fname, info_ext:ExtCols, ext_path=None, fg_path=None, output_format="tsv", compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.output_fname=output_fname
+        self.ext_path=ext_path
+        self.fg_path=fg_path
+        self.path=out_f+"/"+output_fname
+        self.invalid_path=self.path+".invalid.tmp"
+        self.info_ext=info_ext
+        self.output_format=output_format
+        self.writer=open_writer(self.path,output_format,[info_ext.pos],(info_ext.chr,info_ext.pos),compress_level,"invalid_data")
+        self.invalid_writer=None
+        self.stat_parts=[]
+        self.dois=OrderedDict()
+        self.invalid_dois=OrderedDict()
+
+    def add(self, matched_betas):
+        """
+        Append matched betas to the output
+        In: matched betas of a chunk of the external summary
+        """
+        invalid=(matched_betas["invalid_data"]=="YES").to_numpy()
+        valid_data=matched_betas[~invalid]
+        if self.output_format == "tsv.gz":
+            #bgzipped tables are sorted, with the rows with invalid alleles after the others at the same position, so they are not spooled
+            self.writer.write(matched_betas)
+        else:
+            self.writer.write(valid_data)
+            if invalid.any():
+                if self.invalid_writer is None:
+                    self.invalid_writer=spool_writer(self.invalid_path,self.output_format,[self.info_ext.pos])
+                self.invalid_writer.write(matched_betas[invalid])
+        stat_data=valid_data[["unif_beta_ext","unif_beta_fg",self.info_ext.se+"_ext"]].dropna(axis="index",how="any")
+        self.stat_parts.append(stat_data.to_numpy(dtype=np.float64))
+        self.dois.update((doi,None) for doi in valid_data[self.info_ext.study_doi].dropna().unique())
+        self.invalid_dois.update((doi,None) for doi in matched_betas.loc[invalid,self.info_ext.study_doi].dropna().unique())
+
+    def close(self):
+        """
+        Finish the output file
+        Out: tuple of dataframe with columns needed for statistics and comma separated study dois
+        """
+        if self.invalid_writer is not None:
+            self.invalid_writer.close()
+            self.writer.append_spool(self.invalid_path)
+            os.remove(self.invalid_path)
+        self.writer.close()
+        stat_data=pd.DataFrame(np.concatenate(self.stat_parts) if self.stat_parts else np.zeros((0,3)),
+            columns=["unif_beta_ext","unif_beta_fg",self.info_ext.se+"_ext"])
+        dois=OrderedDict(self.dois)
+        dois.update(self.invalid_dois)
+        return (stat_data,','.join(dois))
+
+    def discard(self):
+        """Remove partially written output"""
+        for writer in (self.writer,self.invalid_writer):
+            if writer is not None:
+                writer.close()
+        for path in (self.path,self.invalid_path,self.path+".tbi"):
+            if os.path.exists(path):
+                os.remove(path)
+
+def batch_statistics(stat_parts):
+    """
+    Statistics of several pairs in one batch
+    In: list of arrays with columns unif_beta_ext, unif_beta_fg and ext se, one per pair
+    Out: GroupedStatistics with one value per pair
+    """
+    groups=np.repeat(np.arange(len(stat_parts)),[part.shape[0] for part in stat_parts])
+    stat_data=np.concatenate(stat_parts) if stat_parts else np.zeros((0,3))
+    return grouped_statistics(stat_data[:,0],stat_data[:,1],stat_data[:,2],groups,len(stat_parts))
+
+def r2_row(phenotype, statistics, i, se_imputed, dois_ext):
+    """
+    Row of the r2 table
+    In: phenotype name, batch statistics, index of the pair in the batch, number of imputed standard errors, comma separated study dois
+    Out: dict of r2 table columns, None if there was no data for statistics
+    """
+    n=int(statistics.n[i])
+    if n == 0:
+        return None
+    normal_regression=statistics.regression
+    weighted_regression=statistics.weighted_regression
+    row={"phenotype":phenotype,"R^2":statistics.r2[i],"Weighted R^2 (1/ext var)":statistics.weighted_r2[i],
+        "N (unweighted)":n if n >= 2 else np.nan,"N (weighted)":n if n >= 2 else np.nan, "N (SE imputed)":se_imputed, "study_doi": dois_ext}
+    row.update( {"Regression slope":normal_regression.slope[i],"Weighted regression slope":weighted_regression.slope[i],"Regression intercept":0.0,
+        "Weighted regression intercept":0.0,
+        "Regression std.err.":normal_regression.stderr[i],
+        "Weighted regression std.err.":weighted_regression.stderr[i],
+        "Regression slope p-value": normal_regression.pval[i],
+        "Weighted regression slope p-value": weighted_regression.pval[i]} )
+    return row
+
+#confidence level of bootstrap intervals, and r2 table columns of the resampled statistics
+BOOTSTRAP_CI=0.95
+BOOTSTRAP_COLUMNS=[("r2","R^2"),("weighted_r2","Weighted R^2 (1/ext var)"),("slope","Regression slope"),("weighted_slope","Weighted regression slope")]
+
+def pair_rng(seed, phenotype):
+    """
+    Random generator of a pair. It depends only on the seed and the pair, so results do not change with the other pairs, their order or the number of workers.
+    In: seed, phenotype name of the pair
+    Out: numpy random generator
+    """
+    return np.random.default_rng([seed,zlib.crc32(phenotype.encode())])
+
+def bootstrap_columns(stat_data, phenotype, options:MatchOptions):
+    """
+    Bootstrap confidence intervals and permutation p-values of a pair
+    In: array with columns unif_beta_ext, unif_beta_fg and ext se, phenotype name, match options
+    Out: dict of r2 table columns
+    """
+    results=bootstrap_statistics(stat_data[:,0],stat_data[:,1],stat_data[:,2],options.bootstrap,pair_rng(options.seed,phenotype),BOOTSTRAP_CI)
+    row={}
+    for name,label in BOOTSTRAP_COLUMNS:
+        statistic=getattr(results,name)
+        row["{} {:g}% CI low".format(label,BOOTSTRAP_CI*100)]=statistic.ci_low
+        row["{} {:g}% CI high".format(label,BOOTSTRAP_CI*100)]=statistic.ci_high
+        row["{} permutation p-value".format(label)]=statistic.perm_pval
+    return row
+
+def pair_record(ext_path, fg_path, output_fname, stats, pair_stats, output_bytes=None):
+    """
+    Metrics record of a pair
+    In: ext fpath, fg fpath, output file name, dict of counts from loading the external summary, dict of counts from matching the pair, size of the output file
+    Out: ordered dict of counters and stage timings
+    """
+    record=OrderedDict([("ext",ext_path),("fg",fg_path),("output",output_fname)])
+    for name in ("ext_rows","invalid_alleles","se_imputed"):
+        record[name]=stats.get(name,0)
+    for name in ("fg_opens","tabix_queries","fg_rows","output_rows","matched_rows"):
+        record[name]=pair_stats.get(name,0)
+    record["match_rate"]=record["matched_rows"]/record["output_rows"] if record["output_rows"] > 0 else None
+    record["output_bytes"]=output_bytes
+    record["ext_seconds"]=stats.get("seconds",{})
+    record["seconds"]=pair_stats.get("seconds",{})
+    return record
+
+def group_results(outputs, failed, info_ext:ExtCols, stats, pair_stats, options:MatchOptions=MatchOptions()):
+    """
+    Finish the outputs of the pairs of one external summary and calculate statistics for all of them in one batch
+    In: pair outputs, list of flags for failed pairs, column tuple, dict of counts from loading the external summary, list of dicts of counts from matching each pair, match options
+    Out: list of (output file name, r2 table row (None if there was no data for statistics), metrics record) tuples, None for failed pairs
+    """
+    closed=[None]*len(outputs)
+    for i,output in enumerate(outputs):
+        if not failed[i]:
+            with timed(pair_stats[i],"write"):
+                closed[i]=output.close()
+    stat_parts=[closed[i][0].to_numpy() if closed[i] is not None else np.zeros((0,3)) for i in range(len(outputs))]
+    with timed(stats,"stats"):
+        statistics=batch_statistics(stat_parts)
+    results=[]
+    for i,output in enumerate(outputs):
+        if failed[i]:
+            results.append(None)
+            continue
+        output_fname=output.output_fname
+        phenotype=output_fname.split(".")[0]
+        row=r2_row(phenotype,statistics,i,stats["se_imputed"],closed[i][1])
+        if row is not None and options.bootstrap > 0:
+            with timed(pair_stats[i],"bootstrap"):
+                row.update(bootstrap_columns(stat_parts[i],phenotype,options))
+        record=pair_record(output.ext_path,output.fg_path,output_fname,stats,pair_stats[i],os.path.getsize(output.path))
+        results.append((output_fname,row,record))
+    return results
+
+def match_chunk(ext_data, invalid_ext_data, fg_path, info_ext:ExtCols, info_fg:FGCols, pval_filter, options:MatchOptions, pair_stats):
+    """
+    Match a chunk of a harmonized external summary against an fg summary
+    In: harmonized external variants, invalid external variants, fg fpath, column tuples, p-value filter, match options, dict of counts for the pair
+    Out: matched betas passing the p-value filter
+    """
+    summary_data=load_fg(fg_path,ext_data,info_ext,info_fg,options,pair_stats)
+    with timed(pair_stats,"merge"):
+        matched_betas=join_betas(ext_data,invalid_ext_data,summary_data,info_ext,info_fg,options.compact)
+        matched_betas=matched_betas[matched_betas[info_ext.pval+"_ext"]<=pval_filter]
+    count(pair_stats,"output_rows",matched_betas.shape[0])
+    count(pair_stats,"matched_rows",matched_betas["unif_beta_fg"].notna().sum())
+    return matched_betas
+
+def process_ext_group(ext_path, fg_paths, info_ext:ExtCols, info_fg:FGCols, out_f, pval_filter, options:MatchOptions=MatchOptions(), skip_failed=False):
+    """
+    Match one external summary against all of its fg partners. The external summary is loaded and harmonized once,
+    or chunk by chunk if options.chunk_size is set.
+    In: ext fpath, list of fg fpaths, column tuples, output folder, p-value filter, match options, whether failing pairs are reported and skipped instead of raising
+    Out: list of (output file name, r2 table row, metrics record) tuples in the order of fg_paths, None for skipped pairs
+    """
+    stats={"se_imputed":0}
+    pair_stats=[{} for _ in fg_paths]
+    outputs=[PairOutput(out_f,pair_output_name(ext_path,fg_path,options.output_format),info_ext,ext_path,fg_path,options.output_format,options.compress_level) for fg_path in fg_paths]
+    failed=[False]*len(fg_paths)
+    for full_ext_data in timed_iter(read_ext(ext_path,info_ext,options.chunk_size,options.compact),stats,"load"):
+        ext_data,invalid_ext_data=prepare_ext(full_ext_data,info_ext,stats)
+        del full_ext_data
+        for i,fg_path in enumerate(fg_paths):
+            if failed[i]:
+                continue
+            try:
+                matched_betas=match_chunk(ext_data,invalid_ext_data,fg_path,info_ext,info_fg,pval_filter,options,pair_stats[i])
+                with timed(pair_stats[i],"write"):
+                    outputs[i].add(matched_betas)
+            except Exception:
+                if not skip_failed:
+                    raise
+                print("Matching files {}, {} failed. That pairing is skipped.".format(ext_path,fg_path))
+                traceback.print_exc()
+                outputs[i].discard()
+                failed[i]=True
+    print("{} standard errors imputed from beta and p-value".format(stats["se_imputed"]))
+    release_fg(fg_paths)
+    return group_results(outputs,failed,info_ext,stats,pair_stats,options)
+
+class MatchResult(NamedTuple):
+    fg_path:str
+    matched:"pd.DataFrame"
+    row:Optional[dict]
+    record:dict
+
+def ext_frame(ext_df, info_ext:ExtCols, compact=False):
+    """
+    Copy of an in-memory external summary with the column types read_ext gives
+    In: external summary dataframe, column tuple, whether to use compact mode
+    Out: dataframe
+    """
+    data=ext_df.copy()
+    if compact:
+        data=data[[col for col in data.columns if col in set(info_ext) | {"trait"}]].copy()
+    for col,dtype in ext_dtypes(info_ext).items():
+        if col not in data.columns:
+            continue
+        if dtype is float:
+            data[col]=data[col].astype(float)
+        else:
+            data[col]=data[col].where(data[col].isna(),data[col].astype(str))
+    return compact_frame(data,info_ext.chr,info_ext.pos) if compact else data
+
+def match_pairs(ext, fg_paths, info_ext:ExtCols, info_fg:FGCols, pval_filter=1.0, options:MatchOptions=MatchOptions()) -> List[MatchResult]:
+    """
+    Match an external summary against fg summaries in memory, without writing output files.
+    Gives the same tables and r2 rows as the command line.
+    In: ext fpath or dataframe, fg fpath or list of fg fpaths, column tuples, p-value filter, match options
+    Out: list of MatchResult (fg fpath, matched betas, r2 table row or None, metrics record) in the order of fg_paths
+    """
+    fg_paths=[fg_paths] if isinstance(fg_paths,str) else list(fg_paths)
+    if isinstance(ext,str):
+        ext_path=ext
+        chunks=read_ext(ext,info_ext,options.chunk_size,options.compact)
+    else:
+        ext_path=None
+        chunks=[ext_frame(ext,info_ext,options.compact)]
+    stats={"se_imputed":0}
+    pair_stats=[{} for _ in fg_paths]
+    valid_parts=[[] for _ in fg_paths]
+    invalid_parts=[[] for _ in fg_paths]
+    for full_ext_data in timed_iter(chunks,stats,"load"):
+        ext_data,invalid_ext_data=prepare_ext(full_ext_data,info_ext,stats)
+        for i,fg_path in enumerate(fg_paths):
+            matched_betas=match_chunk(ext_data,invalid_ext_data,fg_path,info_ext,info_fg,pval_filter,options,pair_stats[i])
+            invalid=(matched_betas["invalid_data"]=="YES").to_numpy()
+            valid_parts[i].append(matched_betas[~invalid])
+            invalid_parts[i].append(matched_betas[invalid])
+    release_fg(fg_paths)
+    #rows with invalid alleles come last, like in the output files
+    tables=[pd.concat(valid_parts[i]+invalid_parts[i],ignore_index=True) for i in range(len(fg_paths))]
+    stat_parts=[pd.concat(parts)[["unif_beta_ext","unif_beta_fg",info_ext.se+"_ext"]].dropna(axis="index",how="any").to_numpy(dtype=np.float64)
+        for parts in valid_parts]
+    with timed(stats,"stats"):
+        statistics=batch_statistics(stat_parts)
+    results=[]
+    for i,fg_path in enumerate(fg_paths):
+        output_fname=pair_output_name(ext_path,fg_path,options.output_format) if ext_path is not None else None
+        phenotype=output_fname.split(".")[0] if output_fname is not None else os.path.splitext(os.path.basename(fg_path))[0]
+        invalid=tables[i]["invalid_data"]=="YES"
+        dois=OrderedDict((doi,None) for doi in tables[i].loc[~invalid,info_ext.study_doi].dropna().unique())
+        dois.update((doi,None) for doi in tables[i].loc[invalid,info_ext.study_doi].dropna().unique())
+        row=r2_row(phenotype,statistics,i,stats["se_imputed"],','.join(dois))
+        if row is not None and options.bootstrap > 0:
+            with timed(pair_stats[i],"bootstrap"):
+                row.update(bootstrap_columns(stat_parts[i],phenotype,options))
+        results.append(MatchResult(fg_path,tables[i],row,pair_record(ext_path,fg_path,output_fname,stats,pair_stats[i])))
+    return results
+
+def plan_pairs(pairs):
+    """
+    Group match file pairs by external summary, so that each external summary is loaded once
+    In: list of (ext fpath, fg fpath) tuples
+    Out: list of (ext fpath, list of match file indices, list of fg fpaths) tuples in order of first appearance
+    """
+    groups=OrderedDict()
+    for idx,(ext_path,fg_path) in enumerate(pairs):
+        indices,fg_paths=groups.setdefault(ext_path,([],[]))
+        indices.append(idx)
+        fg_paths.append(fg_path)
+    n_fg=len(set(fg_path for _,fg_path in pairs))
+    #the finngen files actually opened are counted as fg_opens in the run summary
+    print("Planned {} pairs of {} external summaries and {} finngen files".format(len(pairs),len(groups),n_fg))
+    return [(ext_path,indices,fg_paths) for ext_path,(indices,fg_paths) in groups.items()]
+
+def split_groups(groups, n_pairs, workers):
+    """
+    Split planned groups with many fg partners, so that one external summary compared against many fg summaries is
+    spread over all workers. Every part loads the external summary once, so groups are only split into parts of
+    at least n_pairs/workers pairs.
+    In: planned groups from plan_pairs, number of pairs, number of worker processes
+    Out: list of (ext fpath, list of match file indices, list of fg fpaths) tuples
+    """
+    part_size=max(1,-(-n_pairs//workers))
+    parts=[]
+    for ext_path,indices,fg_paths in groups:
+        for start in range(0,len(fg_paths),part_size):
+            parts.append((ext_path,indices[start:start+part_size],fg_paths[start:start+part_size]))
+    return parts
+
+def run_groups(groups, n_pairs, info_ext:ExtCols, info_fg:FGCols, out_f, pval_filter, options, workers):
+    """
+    Run process_ext_group for planned pair groups in a process pool. Large groups are split with split_groups.
+    At most 2*workers groups are submitted at a time to keep memory bounded.
+    In: planned groups from plan_pairs, number of pairs, column tuples, output folder, p-value filter, match options, number of worker processes
+    Out: list of pair results in match file order, None for failed pairs
+    """
+    results=[None]*n_pairs
+    max_inflight=2*workers
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        inflight={}
+        pending=iter(split_groups(groups,n_pairs,workers))
+        while True:
+            for ext_path,indices,fg_paths in islice(pending,max_inflight-len(inflight)):
+                future=executor.submit(process_ext_group,ext_path,fg_paths,info_ext,info_fg,out_f,pval_filter,options,True)
+                inflight[future]=(ext_path,indices)
+            if not inflight:
+                break
+            done,_=wait(inflight,return_when=FIRST_COMPLETED)
+            for future in done:
+                ext_path,indices=inflight.pop(future)
+                try:
+                    for idx,res in zip(indices,future.result()):
+                        results[idx]=res
+                except Exception:
+                    print("Loading file {} failed. Its pairings are skipped.".format(ext_path))
+                    traceback.print_exc()
+    return results
+
+def run_pairs(pairs, info_ext:ExtCols, info_fg:FGCols, out_f, pval_filter, options:MatchOptions=MatchOptions(), workers=1):
+    """
+    Match a list of pairs, loading each external summary once
+    In: list of (ext fpath, fg fpath) tuples, column tuples, output folder, p-value filter, match options, number of worker processes
+    Out: list of pair results in the order of pairs, None for failed pairs
+    """
+    groups=plan_pairs(pairs)
+    if workers > 1:
+        return run_groups(groups,len(pairs),info_ext,info_fg,out_f,pval_filter,options,workers)
+    results=[None]*len(pairs)
+    for ext_path,indices,fg_paths in groups:
+        for idx,res in zip(indices,process_ext_group(ext_path,fg_paths,info_ext,info_fg,out_f,pval_filter,options)):
+            results[idx]=res
+    return results
+
+R2_TABLE="r2_table.tsv"
+MANIFEST="manifest.tsv"
+MANIFEST_COLUMNS=["row","ext","fg","output","r2_row"]
+
+def parse_shard(spec):
+    """
+    Parse a shard given as i/N
+    In: shard string, 0 <= i < N
+    Out: tuple of shard index and number of shards
+    """
+    match=re.fullmatch(r"(\d+)/(\d+)",spec)
+    if match is None or int(match.group(1)) >= int(match.group(2)):
+        raise argparse.ArgumentTypeError("Shard must be given as i/N with 0 <= i < N, got {}".format(spec))
+    return (int(match.group(1)),int(match.group(2)))
+
+def shard_file_name(name, shard:Optional[Tuple[int,int]]):
+    """Name of a per-run file, with the shard in it for sharded runs, e.g. r2_table.shard-0-of-4.tsv"""
+    if shard is None:
+        return name
+    stem,suffix=os.path.splitext(name)
+    return "{}.shard-{}-of-{}{}".format(stem,shard[0],shard[1],suffix)
+
+def read_match_file(match_file):
+    """
+    Read the match file
+    In: match file path
+    Out: list of (ext fpath, fg fpath) tuples
+    """
+    match_df=pd.read_csv(match_file,sep="\t",header=None,names=["EXT","FG"])
+    return list(zip(match_df["EXT"],match_df["FG"]))
+
+def read_sizes(sizes_file):
+    """
+    Read file sizes from a tsv with columns path and size in bytes
+    In: sizes file path
+    Out: dict of path -> size
+    """
+    sizes={}
+    with open(sizes_file) as f:
+        for line in f:
+            fields=line.rstrip("\n").split("\t")
+            if len(fields) >= 2:
+                sizes[fields[0]]=float(fields[1])
+    return sizes
+
+def file_size(path, sizes:Optional[Dict[str,float]]=None):
+    """Size of a file for shard balancing: from sizes if given there, otherwise from disk, 0 if the file is not found"""
+    if sizes is not None and path in sizes:
+        return sizes[path]
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def assign_shards(pairs, n_shards, sizes:Optional[Dict[str,float]]=None):
+    """
+    Assign match file pairs to shards, balanced by input file size. All pairs of an external summary go to the same shard,
+    so it is loaded once. The assignment only depends on the pairs and the file sizes, so every shard computes the same one.
+    In: list of (ext fpath, fg fpath) tuples, number of shards, optional dict of path -> size for files that are not available locally
+    Out: list of shard indices, one per pair
+    """
+    groups=OrderedDict()
+    for idx,(ext_path,fg_path) in enumerate(pairs):
+        groups.setdefault(ext_path,[]).append(idx)
+    costs={ext_path:sum(file_size(ext_path,sizes)+file_size(pairs[idx][1],sizes) for idx in indices) for ext_path,indices in groups.items()}
+    loads=[0.0]*n_shards
+    shards=[0]*len(pairs)
+    #largest groups first, each to the least loaded shard. Ties go by match file order and shard index.
+    for ext_path in sorted(groups,key=lambda e: (-costs[e],groups[e][0])):
+        shard=min(range(n_shards),key=lambda i: (loads[i],i))
+        loads[shard]+=costs[ext_path]
+        for idx in groups[ext_path]:
+            shards[idx]=shard
+    return shards
+
+def write_r2_table(r2s, path):
+    """Write the r2 table"""
+    r2s.to_csv(path,sep="\t",index=False,float_format="%.3g",na_rep="-")
+
+def merge_shards(manifest_paths, out_r2=R2_TABLE, out_manifest=MANIFEST):
+    """
+    Combine the r2 tables and manifests of a sharded run. The r2 table rows are put in match file order, so the merged table
+    is the same as from an unsharded run.
+    In: list of shard manifest paths with their r2 tables next to them, output r2 table path, output manifest path
+    Out: merged manifest dataframe. Raises ValueError unless there is exactly one manifest for every shard.
+    """
+    found={}
+    for path in manifest_paths:
+        match=re.fullmatch(re.escape(os.path.splitext(MANIFEST)[0])+r"\.shard-(\d+)-of-(\d+)"+re.escape(os.path.splitext(MANIFEST)[1]),os.path.basename(path))
+        if match is None:
+            raise ValueError("{} is not a shard manifest written by betamatch.py --shard".format(path))
+        shard=(int(match.group(1)),int(match.group(2)))
+        if shard in found:
+            raise ValueError("Shard {}/{} is given twice: {} and {}".format(shard[0],shard[1],found[shard],path))
+        found[shard]=path
+    n_shards=set(n for _,n in found)
+    if len(n_shards) != 1:
+        raise ValueError("Manifests must be from one sharded run, found numbers of shards {}".format(", ".join(map(str,sorted(n_shards)))))
+    n_shards=n_shards.pop()
+    missing=[str(i) for i in range(n_shards) if (i,n_shards) not in found]
+    if missing:
+        raise ValueError("Manifests of shards {} of {} are missing".format(", ".join(missing),n_shards))
+    manifests=[]
+    rows={}
+    for shard,path in sorted(found.items()):
+        manifest=pd.read_csv(path,sep="\t",keep_default_na=False)
+        r2_path=os.path.join(os.path.dirname(path),shard_file_name(R2_TABLE,shard))
+        if (manifest["r2_row"] >= 0).any():
+            r2s=pd.read_csv(r2_path,sep="\t",keep_default_na=False,na_values=["-"])
+            for row,r2_row in zip(manifest["row"],manifest["r2_row"]):
+                if r2_row >= 0:
+                    rows[row]=r2s.iloc[r2_row].to_dict()
+        manifests.append(manifest)
+    manifest=pd.concat(manifests,ignore_index=True).sort_values("row",kind="stable").reset_index(drop=True)
+    write_r2_table(pd.DataFrame([rows[row] for row in sorted(rows)]),out_r2)
+    manifest.drop(columns=["r2_row"]).to_csv(out_manifest,sep="\t",index=False)
+    return manifest
+
+def main(info_ext:ExtCols,info_fg:FGCols,match_file,out_f,pval_filter,options:MatchOptions=MatchOptions(),workers=1,metrics_file=None,cache:Optional[ResultCache]=None,shard:Optional[Tuple[int,int]]=None,sizes:Optional[Dict[str,float]]=None):
     """
     Match betas between external summ stats and FG summ stats
-    In: folder containing ext summaries, folder containing fg summaries, column tuple, matching tsv file path 
+    In: folder containing ext summaries, folder containing fg summaries, column tuple, matching tsv file path, match options, number of worker processes, optional json lines file for per-pair metrics, optional result cache,
+        optional (shard index, number of shards) to process only the pairs of one shard, optional dict of path -> size used for shard balancing
     Out:  
     """
-    match_df=pd.read_csv(match_file,sep="\t",header=None,names=["EXT","FG"])
-    output_list=[]
-    r2s=[]
-    for _,row in match_df.iterrows():
-        ext_path = row["EXT"]
-        fg_path = row["FG"]
-        fg_name = os.path.splitext(os.path.basename(fg_path))[0]
-        ext_name = os.path.splitext(os.path.basename(ext_path))[0]
+    start_time=time.perf_counter()
+    match_pairs_all=read_match_file(match_file)
+    rows=range(len(match_pairs_all))
+    if shard is not None:
+        #shards are assigned before checking the files, so a shard only needs its own files
+        shards=assign_shards(match_pairs_all,shard[1],sizes)
+        rows=[idx for idx in rows if shards[idx] == shard[0]]
+        print("Shard {}/{}: {} of {} pairs".format(shard[0],shard[1],len(rows),len(match_pairs_all)))
+    pairs=[]
+    pair_rows=[]
+    for idx in rows:
+        ext_path,fg_path=match_pairs_all[idx]
         #check existance
-        print(row)
-        output_fname="{}x{}.betas.tsv".format(ext_name.split(".")[0],fg_name)
+        print(pd.Series({"EXT":ext_path,"FG":fg_path},name=idx))
         if (os.path.exists( ext_path ) ) and ( os.path.exists( fg_path ) ):
-            matched_betas=match_beta(ext_path,fg_path,info_ext,info_fg)
-            matched_betas=matched_betas[matched_betas[info_ext.pval+"_ext"]<=pval_filter]
-            stat_data=matched_betas[["unif_beta_ext","unif_beta_fg",info_ext.se+"_ext"]].dropna(axis="index",how="any")
-            dois_ext=extract_doi(matched_betas,info_ext.study_doi)
-            if not stat_data.empty:
-                r2,w_r2,n_r,n_w=calculate_r2(stat_data,"unif_beta_ext","unif_beta_fg",info_ext.se+"_ext")
-                normal_regression = calculate_regression(stat_data["unif_beta_ext"].values,stat_data["unif_beta_fg"].values )
-                weighted_regression = calculate_regression(stat_data["unif_beta_ext"].values,stat_data["unif_beta_fg"].values,1/(stat_data[info_ext.se+"_ext"]**2) )
-                row={"phenotype":output_fname.split(".")[0],"R^2":r2,"Weighted R^2 (1/ext var)":w_r2,"N (unweighted)":n_r,"N (weighted)":n_w, "study_doi": dois_ext}
-                row.update( {"Regression slope":normal_regression.slope,"Weighted regression slope":weighted_regression.slope,"Regression intercept":0.0,
-                    "Weighted regression intercept":0.0,
-                    "Regression std.err.":normal_regression.stderr,
-                    "Weighted regression std.err.":weighted_regression.stderr,
-                    "Regression slope p-value": normal_regression.pval,
-                    "Weighted regression slope p-value": weighted_regression.pval} )
-                r2s.append(row)
-
-            matched_betas.to_csv(path_or_buf=out_f+"/"+output_fname,index=False,sep="\t",na_rep="-")
-            output_list.append(output_fname)
+            pairs.append((ext_path,fg_path))
+            pair_rows.append(idx)
         else:
             print("One of the files {}, {} does not exist. That pairing is skipped.".format(ext_path,fg_path))
-    r2s=pd.DataFrame(r2s)
-    r2s.to_csv("r2_table.tsv",sep="\t",index=False,float_format="%.3g",na_rep="-")
+    #fail fast on wrong column names. Unreadable files are reported when their pairs are processed.
+    for fg_path in OrderedDict.fromkeys(fg_path for _,fg_path in pairs):
+        try:
+            check_fg_columns(fg_path,info_fg)
+        except OSError:
+            pass
+    results=[None]*len(pairs)
+    cache_keys={}
+    if cache is not None:
+        #lookup strategy and chunk size do not change the results
+        settings={"info_ext":list(info_ext),"info_fg":list(info_fg),"pval_filter":pval_filter,"output_format":options.output_format}
+        if options.bootstrap > 0:
+            settings.update(bootstrap=options.bootstrap,seed=options.seed)
+        if options.output_format == "tsv.gz":
+            settings.update(compress_level=options.compress_level)
+        for idx,(ext_path,fg_path) in enumerate(pairs):
+            output_fname=pair_output_name(ext_path,fg_path,options.output_format)
+            phenotype=output_fname.split(".")[0]
+            #the key has the file contents, not their names. Bootstrap results depend on the name through pair_rng.
+            key=cache.key(ext_path,fg_path,dict(settings,phenotype=phenotype) if options.bootstrap > 0 else settings)
+            hit=cache.get(key,out_f+"/"+output_fname)
+            if hit is None:
+                cache_keys[idx]=key
+                continue
+            row,record=hit
+            if options.output_format == "tsv.gz":
+                #only the table is cached, its tabix index is rebuilt
+                index_table(out_f+"/"+output_fname,info_ext.chr,info_ext.pos)
+            #the entry may come from copies of the files under other names or paths
+            if row is not None:
+                row["phenotype"]=phenotype
+            record.update(ext=ext_path,fg=fg_path,output=output_fname,cached=True)
+            results[idx]=(output_fname,row,record)
+        print("{} of {} pairs found in cache {}".format(len(pairs)-len(cache_keys),len(pairs),cache.cache_dir))
+    todo=[idx for idx in range(len(pairs)) if results[idx] is None]
+    for idx,res in zip(todo,run_pairs([pairs[idx] for idx in todo],info_ext,info_fg,out_f,pval_filter,options,workers)):
+        results[idx]=res
+        if res is not None:
+            res[2]["cached"]=False
+            if cache is not None:
+                cache.put(cache_keys[idx],out_f+"/"+res[0],res[1],res[2])
+    if cache is not None:
+        removed=cache.evict()
+        if removed:
+            print("Evicted {} entries from cache {}".format(removed,cache.cache_dir))
+    if shard is not None:
+        manifest=[]
+        r2_idx=0
+        for idx,res in enumerate(results):
+            if res is None:
+                continue
+            ext_path,fg_path=pairs[idx]
+            manifest.append([pair_rows[idx],ext_path,fg_path,res[0],r2_idx if res[1] is not None else -1])
+            r2_idx+=res[1] is not None
+        pd.DataFrame(manifest,columns=MANIFEST_COLUMNS).to_csv(shard_file_name(MANIFEST,shard),sep="\t",index=False)
+    results=[res for res in results if res is not None]
+    output_list=[output_fname for output_fname,_,_ in results]
+    r2s=pd.DataFrame([row for _,row,_ in results if row is not None])
+    write_r2_table(r2s,shard_file_name(R2_TABLE,shard))
     print("The following files were created:")
     [print(s) for s in output_list]
+    records=[record for _,_,record in results]
+    if metrics_file is not None:
+        write_metrics(metrics_file,records)
+    print(summarize(records,time.perf_counter()-start_time,peak_rss_mb()))
 
 
 if __name__=="__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "index":
+        index_parser=argparse.ArgumentParser(prog="betamatch.py index",description="Build binary indexes of finngen summary statistics for fast matching")
+        index_parser.add_argument("fg_files",nargs="+",help="finngen summary files")
+        index_parser.add_argument("--info-fg",nargs=7,required=True,metavar=("#chrom","pos","ref","alt","beta","pval","se"),help="column names for finngen file")
+        index_parser.add_argument("--index-dir",default=None,help="Folder for the indexes. By default indexes are written next to the finngen files.")
+        args=index_parser.parse_args(sys.argv[2:])
+        for fg_file in args.fg_files:
+            print("Indexed {} to {}".format(fg_file,build_index(fg_file,args.info_fg,index_path_for(fg_file,args.index_dir))))
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "merge":
+        merge_parser=argparse.ArgumentParser(prog="betamatch.py merge",description="Combine the r2 tables and manifests of a run with --shard")
+        merge_parser.add_argument("manifests",nargs="+",help="manifest files of all shards, with the shard r2 tables in the same folders")
+        merge_parser.add_argument("--out",default=R2_TABLE,help="Merged r2 table")
+        merge_parser.add_argument("--manifest-out",default=MANIFEST,help="Merged manifest of all output files")
+        args=merge_parser.parse_args(sys.argv[2:])
+        manifest=merge_shards(args.manifests,args.out,args.manifest_out)
+        print("Merged {} pairs from {} shards into {}".format(manifest.shape[0],len(args.manifests),args.out))
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "shard":
+        shard_parser=argparse.ArgumentParser(prog="betamatch.py shard",description="List the finngen files of every shard of a match file, e.g. to localize only those in scattered workflows")
+        shard_parser.add_argument("--match-file",required=True,help="Match file")
+        shard_parser.add_argument("--shards",required=True,type=int,help="Number of shards")
+        shard_parser.add_argument("--sizes",default=None,help="tsv of file path and size in bytes for files that are not available locally")
+        shard_parser.add_argument("--out-prefix",default="shard",help="Prefix of the written lists, PREFIX-i-of-N.txt. i is zero padded, so the lists sort in shard order.")
+        args=shard_parser.parse_args(sys.argv[2:])
+        match_pairs_all=read_match_file(args.match_file)
+        shards=assign_shards(match_pairs_all,args.shards,read_sizes(args.sizes) if args.sizes is not None else None)
+        for i in range(args.shards):
+            fg_paths=OrderedDict.fromkeys(fg_path for (_,fg_path),shard in zip(match_pairs_all,shards) if shard == i)
+            with open("{}-{:0{}d}-of-{}.txt".format(args.out_prefix,i,len(str(args.shards-1)),args.shards),"w") as f:
+                f.writelines(fg_path+"\n" for fg_path in fg_paths)
+            print("Shard {}/{}: {} pairs, {} finngen files".format(i,args.shards,shards.count(i),len(fg_paths)))
+        sys.exit(0)
     parser=argparse.ArgumentParser(description="Match beta of summary statistic and external summaries")
     #parser.add_argument("--folder",type=str,required=True,help="Folder containing the external summaries that are meant to be used. Files should be names like FinnGen phenotypes.")
     #parser.add_argument("--summaryfolder",type=str,required=True,help="Finngen summary statistic folder")
@@ -243,6 +989,22 @@ if __name__=="__main__":
     parser.add_argument("--match-file",required=True,help="List containing the comparisons to be done, as a tsv with columns FG and EXT")
     parser.add_argument("--output-folder",required=True,help="Output folder")
     parser.add_argument("--pval-filter",default=1.0,type=float,help="Filter p-value for summary file")
+    parser.add_argument("--workers",default=1,type=int,help="Number of match file pairs processed in parallel. The finngen partners of one external summary are split over the workers, each loading the external summary once.")
+    parser.add_argument("--lookup",default="auto",choices=LOOKUP_STRATEGIES,help="How variants are fetched from finngen files: coalesced tabix region queries, one streaming pass over the file, a binary index built with 'betamatch.py index', or automatically (index if up to date, otherwise by variant count, and with --chunk-size region queries until the chunks of a file ask for more variants than one pass over it, which then builds a temporary index of the file)")
+    parser.add_argument("--index-dir",default=None,help="Folder containing binary indexes of finngen files. By default indexes are looked up next to the finngen files.")
+    parser.add_argument("--metrics",default=None,help="Write per-pair stage timings and counters to this json lines file")
+    parser.add_argument("--output-format",default="tsv",choices=OUTPUT_FORMATS,help="Format of the matched beta tables. parquet and feather need pyarrow. tsv.gz tables are sorted by chromosome and position, bgzipped and tabix indexed.")
+    parser.add_argument("--compress-level",default=DEFAULT_COMPRESS_LEVEL,type=int,choices=range(0,10),metavar="0-9",help="Compression level of tsv.gz outputs")
+    parser.add_argument("--cache-dir",default=default_cache_dir(),help="Folder for cached pair results. Pairs whose inputs and settings have not changed are copied from the cache instead of matched again.")
+    parser.add_argument("--no-cache",action="store_true",help="Do not read or write the result cache")
+    parser.add_argument("--cache-max-size",default=10.0,type=float,help="Evict least recently used cache entries when the cache is larger than this many GB")
+    parser.add_argument("--cache-max-age",default=30.0,type=float,help="Evict cache entries that have not been used for this many days")
+    parser.add_argument("--chunk-size",default=None,type=int,help="Stream external summaries in chunks of this many rows to keep memory use flat. Matched rows are appended to the outputs chunk by chunk.")
+    parser.add_argument("--compact",action="store_true",help="Lower memory use: read only the columns written to the outputs, store chromosomes as categories and positions as integers, and join on integer keys of the positions and alleles. The outputs do not change.")
+    parser.add_argument("--bootstrap",default=0,type=int,metavar="B",help="Add {:g}%% bootstrap confidence intervals and permutation p-values of R^2 and regression slopes to the r2 table, from B resamples and B permutations per pair".format(BOOTSTRAP_CI*100))
+    parser.add_argument("--seed",default=0,type=int,help="Random seed for --bootstrap. Every pair gets its own generator derived from the seed and the pair.")
+    parser.add_argument("--shard",default=None,type=parse_shard,metavar="i/N",help="Process only shard i (0 <= i < N) of the match file pairs. Shards are balanced by file size and are combined with 'betamatch.py merge'.")
+    parser.add_argument("--sizes",default=None,help="tsv of file path and size in bytes, used for balancing shards when not all files are available locally")
     args=parser.parse_args()
     extcols = ExtCols(
         args.info_ext[0],
@@ -264,4 +1026,6 @@ if __name__=="__main__":
         args.info_fg[6]
     )
 
-    main(extcols,fgcols,args.match_file,args.output_folder,args.pval_filter)
+    options = MatchOptions(args.lookup,args.index_dir,args.chunk_size,args.output_format,args.compact,args.bootstrap,args.seed,args.compress_level)
+    cache = None if args.no_cache else ResultCache(args.cache_dir,int(args.cache_max_size*1e9),args.cache_max_age)
+    main(extcols,fgcols,args.match_file,args.output_folder,args.pval_filter,options,args.workers,args.metrics,cache,args.shard,read_sizes(args.sizes) if args.sizes is not None else None)
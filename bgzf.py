@@ -0,0 +1,236 @@
+#! /usr/bin/env python3
+"""BGZF compression and tabix indexing of tab separated files, without htslib binaries."""
+import os, struct, zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional
+
+#uncompressed bytes per block, as in htslib
+BLOCK_SIZE=0xff00
+#empty block marking the end of a BGZF file
+EOF_BLOCK=bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+#tabix binning parameters
+MIN_SHIFT=14
+DEPTH=5
+
+def compress_block(data: bytes, level: int=6) -> bytes:
+    """Compress up to BLOCK_SIZE bytes into one BGZF block"""
+    compressor=zlib.compressobj(level,zlib.DEFLATED,-15)
+    deflated=compressor.compress(data)+compressor.flush()
+    header=struct.pack("<BBBBIBBHBBHH",0x1f,0x8b,8,4,0,0,0xff,6,ord("B"),ord("C"),2,len(deflated)+25)
+    return header+deflated+struct.pack("<II",zlib.crc32(data) & 0xffffffff,len(data))
+
+class BgzfWriter:
+    """Write-only BGZF file.
+    With threads > 0 or an executor, blocks are compressed in background threads while the caller goes on, and written in order.
+    zlib releases the GIL, so compression runs in parallel with the caller and with other blocks.
+    A shared executor is not shut down on close. max_pending blocks may wait for compression or writing before write
+    blocks the caller, by default 4 per thread.
+    """
+    def __init__(self, path: str, level: int=6, threads: int=0, executor: Optional[ThreadPoolExecutor]=None, max_pending: Optional[int]=None):
+        self.handle=open(path,"wb")
+        self.level=level
+        self.buffer=bytearray()
+        self.block_offset=0
+        self.own_executor=executor is None and threads > 0
+        self.executor=ThreadPoolExecutor(threads) if self.own_executor else executor
+        #compressed blocks not yet written, at most max_pending
+        self.pending=deque()
+        self.max_pending=max_pending if max_pending is not None else 4*threads
+
+    def tell(self) -> int:
+        """Virtual offset of the next byte written"""
+        self._drain(0)
+        return (self.block_offset << 16) | len(self.buffer)
+
+    def write(self, data):
+        if isinstance(data,str):
+            data=data.encode()
+        self.buffer.extend(data)
+        n_full=len(self.buffer)//BLOCK_SIZE*BLOCK_SIZE
+        if n_full == 0:
+            return
+        full=bytes(self.buffer[:n_full])
+        del self.buffer[:n_full]
+        for start in range(0,n_full,BLOCK_SIZE):
+            self._write_block(full[start:start+BLOCK_SIZE])
+
+    def _write_block(self, data: bytes):
+        if self.executor is None:
+            self._write_compressed(compress_block(data,self.level))
+            return
+        self.pending.append(self.executor.submit(compress_block,data,self.level))
+        self._drain(self.max_pending)
+
+    def _write_compressed(self, block: bytes):
+        self.handle.write(block)
+        self.block_offset+=len(block)
+
+    def _drain(self, max_pending: int):
+        """Write compressed blocks until at most max_pending are left"""
+        while len(self.pending) > max_pending:
+            self._write_compressed(self.pending.popleft().result())
+
+    def flush(self):
+        """Compress buffered data into a block, so that the next write starts a new block"""
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+            self.buffer=bytearray()
+
+    def append_bgzf(self, path: str):
+        """Append the blocks of a BGZF file without its end of file block. Blocks are copied without decompressing them."""
+        self.flush()
+        self._drain(0)
+        size=os.path.getsize(path)
+        with open(path,"rb") as f:
+            if size >= len(EOF_BLOCK):
+                f.seek(size-len(EOF_BLOCK))
+                if f.read() == EOF_BLOCK:
+                    size-=len(EOF_BLOCK)
+                f.seek(0)
+            while size > 0:
+                block=f.read(min(size,1<<20))
+                self._write_compressed(block)
+                size-=len(block)
+
+    def close(self):
+        self.flush()
+        self._drain(0)
+        if self.own_executor:
+            self.executor.shutdown()
+        self.handle.write(EOF_BLOCK)
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_blocks(path: str):
+    """Iterate over the blocks of a BGZF file
+    In: file path
+    Out: iterator of (compressed offset of block, uncompressed data) tuples
+    """
+    with open(path,"rb") as f:
+        offset=0
+        while True:
+            header=f.read(18)
+            if len(header) < 18:
+                return
+            bsize=struct.unpack("<H",header[16:18])[0]
+            rest=f.read(bsize-17)
+            yield (offset,zlib.decompress(rest[:-8],-15))
+            offset+=bsize+1
+
+def block_offsets(path: str) -> List[int]:
+    """Compressed offsets of the blocks of a BGZF file, read from the block headers only"""
+    offsets=[]
+    size=os.path.getsize(path)
+    with open(path,"rb") as f:
+        offset=0
+        while offset < size:
+            f.seek(offset)
+            header=f.read(18)
+            offsets.append(offset)
+            offset+=struct.unpack("<H",header[16:18])[0]+1
+    return offsets
+
+def reg2bin(beg: int, end: int) -> int:
+    """Smallest tabix bin containing the 0-based half open interval [beg,end)"""
+    end-=1
+    for level in range(DEPTH,0,-1):
+        shift=MIN_SHIFT+3*(DEPTH-level)
+        if beg >> shift == end >> shift:
+            return ((1 << 3*level)-1)//7+(beg >> shift)
+    return 0
+
+def tabix_index(path: str, seq_col: int, beg_col: int, end_col: Optional[int]=None, meta_char: str="#", skip: int=0) -> str:
+    """Create a tabix index for a sorted BGZF compressed tab separated file
+    In: file path, 1-based sequence, start and end columns, comment character, number of header lines to skip
+    Out: index path
+    """
+    end_col=end_col if end_col is not None else beg_col
+    names=OrderedDict()
+    bins=[]
+    linear=[]
+    n_no_coor=0
+    meta=meta_char.encode()
+    line_no=0
+    partial=b""
+    line_start=0
+    for block_offset,data in read_blocks(path):
+        pos_in_block=-len(partial)
+        data=partial+data
+        start=0
+        while True:
+            nl=data.find(b"\n",start)
+            if nl < 0:
+                break
+            line=data[start:nl]
+            #virtual offsets of the start of this line and of the next line
+            voff_beg=line_start
+            next_pos=pos_in_block+nl+1
+            voff_end=(block_offset << 16) | next_pos
+            line_start=voff_end
+            start=nl+1
+            line_no+=1
+            if line_no <= skip or line.startswith(meta) or not line:
+                continue
+            fields=line.split(b"\t")
+            chrom=fields[seq_col-1].decode()
+            try:
+                beg=int(fields[beg_col-1])-1
+                end=int(fields[end_col-1]) if end_col != beg_col else beg+1
+            except ValueError:
+                n_no_coor+=1
+                continue
+            if chrom not in names:
+                names[chrom]=len(names)
+                bins.append({})
+                linear.append([])
+            tid=names[chrom]
+            chunks=bins[tid].setdefault(reg2bin(beg,end),[])
+            if chunks and chunks[-1][1] == voff_beg:
+                chunks[-1][1]=voff_end
+            else:
+                chunks.append([voff_beg,voff_end])
+            lin=linear[tid]
+            last_window=(end-1) >> MIN_SHIFT
+            if len(lin) <= last_window:
+                lin.extend([None]*(last_window+1-len(lin)))
+            for window in range(beg >> MIN_SHIFT,last_window+1):
+                if lin[window] is None:
+                    lin[window]=voff_beg
+        partial=data[start:]
+    return write_tabix_index(path+".tbi",list(names),bins,linear,n_no_coor,seq_col,beg_col,end_col,meta_char,skip)
+
+def write_tabix_index(index_path: str, names: List[str], bins: List[Dict[int,List[List[int]]]], linear: List[List[Optional[int]]], n_no_coor: int,
+        seq_col: int, beg_col: int, end_col: int, meta_char: str="#", skip: int=0) -> str:
+    """Write a tabix index
+    In: index path, sequence names in file order, dict of bin -> list of [begin,end] virtual offset chunks and list of
+        linear index virtual offsets (None for windows without records) per sequence, number of records without coordinates,
+        1-based sequence, start and end columns, comment character, number of header lines to skip
+    Out: index path
+    """
+    out=bytearray(b"TBI\x01")
+    name_bytes=b"".join(name.encode()+b"\x00" for name in names)
+    out+=struct.pack("<iiiiiiii",len(names),0,seq_col,beg_col,end_col,ord(meta_char),skip,len(name_bytes))
+    out+=name_bytes
+    for tid in range(len(names)):
+        out+=struct.pack("<i",len(bins[tid]))
+        for bin_id,chunks in bins[tid].items():
+            out+=struct.pack("<Ii",bin_id,len(chunks))
+            for beg,end in chunks:
+                out+=struct.pack("<QQ",beg,end)
+        lin=linear[tid]
+        #windows without records point to the previous window
+        for i in range(len(lin)):
+            if lin[i] is None:
+                lin[i]=lin[i-1] if i > 0 else next(v for v in lin if v is not None)
+        out+=struct.pack("<i",len(lin))
+        out+=struct.pack("<{}Q".format(len(lin)),*lin)
+    out+=struct.pack("<Q",n_no_coor)
+    with BgzfWriter(index_path) as f:
+        f.write(bytes(out))
+    return index_path
@@ -1,16 +1,26 @@
 #! /usr/bin/env python3
-import pandas as pd,numpy as np #type: ignore
-from plotnine import *
-import argparse,glob,os
+import argparse,glob,os,shutil,tempfile
 import traceback
 import re
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Dict, Any, Optional
+from collections import OrderedDict
 
-from beta_utils import *
+from lazy import lazy_import
+from beta_utils import calculate_r2, calculate_regression
+from table_formats import OUTPUT_FORMATS, table_suffix, read_table
+pd=lazy_import("pandas") #type: ignore
+np=lazy_import("numpy") #type: ignore
+p9=lazy_import("plotnine")
+
+try:
+    pypdf=lazy_import("pypdf")
+except ImportError:
+    pypdf=None
 
 r = re.compile("x10",re.IGNORECASE)
 
-def main(plot_data, pheno, fields,se_fields, x_title, y_title, output_name, pval_field=None, p_threshold=None, exp_betas=False):
+def main(plot_data, pheno, fields,se_fields, x_title, y_title, output_name, pval_field=None, p_threshold=None, exp_betas=False, max_points=None):
     if pval_field is not None:
         ## recode unparsable floats
         if plot_data[pval_field].dtype!=np.float64:
@@ -47,7 +57,8 @@ def main(plot_data, pheno, fields,se_fields, x_title, y_title, output_name, pval
     reg_w = calculate_regression(plot_data[x_title].values,plot_data[y_title].values,weights=1/(plot_data[se_fields[0]]**2))
     (r_2_normal,r_2_weighted,N_normal, N_weighted) = calculate_r2(plot_data,x_title,y_title,se_fields[0]) 
 
-    x = np.linspace(-100,100,num=plot_data.shape[0])
+    n_line = plot_data.shape[0] if max_points is None else min(plot_data.shape[0],max_points)
+    x = np.linspace(-100,100,num=n_line)
     y = reg.slope*x
     w_y = reg_w.slope*x
     linedata = pd.DataFrame({x_title:x, y_title:y})
@@ -68,7 +79,7 @@ def main(plot_data, pheno, fields,se_fields, x_title, y_title, output_name, pval
     if exp_betas:
         xlim=(np.min(plot_data[x_title]),np.max(plot_data[x_title]))
         ylim=(1,np.max(plot_data[y_title]))
-        x=np.linspace(xlim[0],xlim[1],num=plot_data.shape[0])
+        x=np.linspace(xlim[0],xlim[1],num=n_line)
         y=reg.slope*x
         linedata=pd.DataFrame({x_title:x, y_title:y})
         perf_corr=pd.DataFrame({x_title:x,y_title:x})
@@ -83,31 +94,86 @@ def main(plot_data, pheno, fields,se_fields, x_title, y_title, output_name, pval
     plot_data["ci_y_pos"] = plot_data[y_title]+y_ci
     plot_data["ci_y_neg"] = plot_data[y_title]-y_ci
 
+    if max_points is not None and plot_data.shape[0] > max_points:
+        #too many points to draw one by one, show their density instead. Lines and annotations still use all data.
+        points=[p9.geom_bin_2d(bins=100)]
+    else:
+        points=[p9.geom_errorbar(mapping=p9.aes(x=x_title,ymin="ci_y_neg",ymax="ci_y_pos",width=0.0),alpha=0.2),
+            p9.geom_errorbarh(mapping=p9.aes(y=y_title,xmin="ci_x_neg",xmax="ci_x_pos",height=0.0),alpha=0.2),
+            p9.geom_point(color="red",size=0.5)]
 
     #breaks=[-max_val,0,max_val]
-    plot=(ggplot(data=plot_data,mapping=aes(x=x_title,y=y_title))+
-        geom_line(data=linedata,mapping=aes(x=x_title,y=y_title),color="#666666" )+
-        geom_line(data=linedata_weighted,mapping=aes(x=x_title,y=y_title),linetype="dashdot",color="#666666" )+
-        geom_line(data=perf_corr,mapping=aes(x=x_title,y=y_title),linetype="dashed",color="#888888" )+
-        geom_errorbar(mapping=aes(x=x_title,ymin="ci_y_neg",ymax="ci_y_pos",width=0.0),alpha=0.2)+
-        geom_errorbarh(mapping=aes(y=y_title,xmin="ci_x_neg",xmax="ci_x_pos",height=0.0),alpha=0.2)+
-        geom_point(color="red",size=0.5)+
-        annotate("text",label="R^2 (pearson):{:>5.2g}  slope:{:>5.2g}  se(slope):{:>5.2g}".format(r_2_normal,reg.slope,reg.stderr),x=xlim[0]+(xlim[1]-xlim[0])*0.5,y=ylim[0]+(ylim[1]-ylim[0])*0.99,size=10 )+
-        annotate("text",label="R^2 (weighted):{:>5.2g}  slope:{:>5.2g}  se(slope):{:>5.2g}".format(r_2_weighted,reg_w.slope,reg_w.stderr),x=xlim[0]+(xlim[1]-xlim[0])*0.5,y=ylim[0]+(ylim[1]-ylim[0])*0.94,size=10 )+
-        coord_cartesian(xlim=xlim,ylim=ylim)+
-        ggtitle(pheno)+
+    plot=(p9.ggplot(data=plot_data,mapping=p9.aes(x=x_title,y=y_title))+
+        p9.geom_line(data=linedata,mapping=p9.aes(x=x_title,y=y_title),color="#666666" )+
+        p9.geom_line(data=linedata_weighted,mapping=p9.aes(x=x_title,y=y_title),linetype="dashdot",color="#666666" )+
+        p9.geom_line(data=perf_corr,mapping=p9.aes(x=x_title,y=y_title),linetype="dashed",color="#888888" )+
+        points+
+        p9.annotate("text",label="R^2 (pearson):{:>5.2g}  slope:{:>5.2g}  se(slope):{:>5.2g}".format(r_2_normal,reg.slope,reg.stderr),x=xlim[0]+(xlim[1]-xlim[0])*0.5,y=ylim[0]+(ylim[1]-ylim[0])*0.99,size=10 )+
+        p9.annotate("text",label="R^2 (weighted):{:>5.2g}  slope:{:>5.2g}  se(slope):{:>5.2g}".format(r_2_weighted,reg_w.slope,reg_w.stderr),x=xlim[0]+(xlim[1]-xlim[0])*0.5,y=ylim[0]+(ylim[1]-ylim[0])*0.94,size=10 )+
+        p9.coord_cartesian(xlim=xlim,ylim=ylim)+
+        p9.ggtitle(pheno)+
         #scale_x_continuous(limits=xlim)+
         #scale_y_continuous(limits=ylim)+
-        theme_minimal()+
-        theme(
-            axis_ticks_major=element_line(color="black"),
+        p9.theme_minimal()+
+        p9.theme(
+            axis_ticks_major=p9.element_line(color="black"),
             axis_ticks_minor=None,
-            axis_line_x=element_line(color="black"),
-            axis_line_y=element_line(color="black")
+            axis_line_x=p9.element_line(color="black"),
+            axis_line_y=p9.element_line(color="black")
         )
           )
     #d=plot.draw()
-    return plot+theme(figure_size=(6,6))
+    return plot+p9.theme(figure_size=(6,6))
+
+def plot_file(f, fields, se_fields, x_title, y_title, out, pval_field=None, p_threshold=None, exp_betas=False, max_points=None):
+    """
+    Plot one matched betas file
+    In: file path, plot options
+    Out: plot, or None if the file could not be plotted
+    """
+    out_fname=os.path.basename(f).split(".")[0] + out
+    try:
+        columns=list(fields)+list(se_fields)+([pval_field] if pval_field is not None else [])
+        plot_data=read_table(f,list(OrderedDict.fromkeys(columns)))
+        #extract columns
+        pheno = os.path.basename(f).split(".")[0]
+        print(f"plotting {f}")
+        return main(plot_data, pheno,fields,se_fields,x_title,y_title,out_fname, pval_field, p_threshold, exp_betas=exp_betas, max_points=max_points )
+    except Exception as e:
+        print(f'An exception occurred while plotting {str(e)} \n{traceback.print_exc()}')
+        return None
+
+def render_page(job):
+    """
+    Render the plot of one file into a single page pdf
+    In: tuple of page pdf path and plot_file arguments
+    Out: page pdf path, or None if there was nothing to plot
+    """
+    page_path,plot_args = job
+    p = plot_file(*plot_args)
+    if p is None:
+        return None
+    p9.save_as_pdf_pages([p],filename=page_path,verbose=False)
+    return page_path
+
+def render_parallel(jobs, out, workers):
+    """
+    Render pages in worker processes and merge them into one pdf in the order of jobs
+    In: list of plot_file arguments, output pdf path, number of worker processes
+    """
+    page_dir=tempfile.mkdtemp(prefix="corrplot_",dir=os.path.dirname(os.path.abspath(out)))
+    try:
+        page_jobs=[(os.path.join(page_dir,"{}.pdf".format(i)),job) for i,job in enumerate(jobs)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pages=list(executor.map(render_page,page_jobs))
+        writer=pypdf.PdfWriter()
+        for page in pages:
+            if page is not None:
+                writer.append(page)
+        with open(out,"wb") as f:
+            writer.write(f)
+    finally:
+        shutil.rmtree(page_dir)
 
 if __name__=="__main__":
     parser=argparse.ArgumentParser("A utility for plotting correlations from tsv data")
@@ -120,19 +186,17 @@ if __name__=="__main__":
     parser.add_argument("--x-title",default="x-axis",help="title for x axis")
     parser.add_argument("--y-title",default="y-axis",help="title for y axis")
     parser.add_argument("--out",default="plots.pdf",help="output file name")
+    parser.add_argument("--workers",type=int,default=1,help="Number of processes rendering pages in parallel. Needs pypdf for merging the pages.")
+    parser.add_argument("--max-points",type=int,default=None,help="Plot the density of points instead of single points and error bars when a plot has more points than this. Regression and R^2 still use all points.")
     args=parser.parse_args()
-    files=glob.glob("{}/*.tsv".format(args.folder) )
-    plots = []
-    for f in files:
-        out_fname=os.path.basename(f).split(".")[0] + args.out
-        try:
-            plot_data=pd.read_csv(f,sep="\t",na_values="-")
-            #extract columns
-            pheno = os.path.basename(f).split(".")[0]
-            print(f"plotting {f}")
-            p = main(plot_data, pheno,args.fields,args.se_fields,args.x_title,args.y_title,out_fname, args.pval_field, args.pval_threshold, exp_betas=args.exp_values )
-            plots.append(p)
-        except Exception as e:
-            print(f'An exception occurred while plotting {str(e)} \n{traceback.print_exc()}')
-    plots=[x for x in plots if x != None]
-    save_as_pdf_pages(plots,filename=args.out)
+    #pages follow file names, not the directory order of glob
+    files=sorted(glob.glob("{}/*.tsv".format(args.folder) )+[f for fmt in OUTPUT_FORMATS if fmt != "tsv" for f in glob.glob("{}/*{}".format(args.folder,table_suffix(fmt)))])
+    jobs=[(f,args.fields,args.se_fields,args.x_title,args.y_title,args.out,args.pval_field,args.pval_threshold,args.exp_values,args.max_points) for f in files]
+    if args.workers > 1 and pypdf is None:
+        print("pypdf is not installed, rendering pages serially")
+    if args.workers > 1 and pypdf is not None:
+        render_parallel(jobs,args.out,args.workers)
+    else:
+        plots=[plot_file(*job) for job in jobs]
+        plots=[x for x in plots if x != None]
+        p9.save_as_pdf_pages(plots,filename=args.out)
@@ -0,0 +1,163 @@
+#! /usr/bin/env python3
+"""Compact binary index of FinnGen summary statistics.
+The index is a folder of numpy arrays sorted by chromosome and position, which are memory-mapped for lookups.
+"""
+import csv, json, os
+from typing import List, Dict, Optional
+from lazy import lazy_import
+np=lazy_import("numpy") #type: ignore
+pd=lazy_import("pandas") #type: ignore
+
+INDEX_SUFFIX=".bmidx"
+INDEX_VERSION=1
+BUILD_CHUNKSIZE=1000000
+#columns of the index, in the order of the --info-fg columns
+INDEX_FIELDS=("chr","pos","ref","alt","beta","pval","se")
+
+def index_path_for(fg_summary: str, index_dir: Optional[str]=None) -> str:
+    """Path of the index of an fg file
+    In: fg file path, optional folder containing indexes
+    Out: index folder path
+    """
+    if index_dir is None:
+        return fg_summary+INDEX_SUFFIX
+    return os.path.join(index_dir,os.path.basename(fg_summary)+INDEX_SUFFIX)
+
+def source_identity(fg_summary: str) -> Dict:
+    """Size and modification time of an fg file, used to detect stale indexes"""
+    st=os.stat(fg_summary)
+    return {"size":st.st_size,"mtime":st.st_mtime}
+
+def _encode_alleles(alleles: "pd.Series", vocab: Dict[str,int]) -> "np.ndarray":
+    """Map allele strings to integer codes, adding new alleles to vocab"""
+    for allele in pd.unique(alleles.to_numpy()):
+        if allele not in vocab:
+            vocab[allele]=len(vocab)
+    return alleles.map(vocab).to_numpy(dtype=np.int32)
+
+def _parse_floats(values: "pd.Series") -> "np.ndarray":
+    """Parse numbers like the text lookups do, so that indexed values are the same to the last bit
+    In: column of number strings
+    Out: float64 array, NaN for unparseable values
+    """
+    try:
+        return values.astype(float).to_numpy(dtype=np.float64)
+    except ValueError:
+        out=np.full(values.size,np.nan)
+        for i,value in enumerate(values):
+            try:
+                out[i]=float(value)
+            except ValueError:
+                pass
+        return out
+
+def build_index(fg_summary: str, columns: List[str], index_path: Optional[str]=None) -> str:
+    """Convert an fg summary into a binary index
+    In: fg file path, fg column names (chr,pos,ref,alt,beta,pval,se), optional index folder path
+    Out: index folder path
+    """
+    index_path=index_path if index_path is not None else index_path_for(fg_summary)
+    cols=dict(zip(INDEX_FIELDS,columns))
+    identity=source_identity(fg_summary)
+    chrom_names={}
+    allele_vocab={}
+    parts={field:[] for field in INDEX_FIELDS}
+    reader=pd.read_csv(fg_summary,sep="\t",usecols=list(columns),dtype=str,na_filter=False,quoting=csv.QUOTE_NONE,chunksize=BUILD_CHUNKSIZE)
+    for chunk in reader:
+        for chrom in pd.unique(chunk[cols["chr"]].to_numpy()):
+            chrom_names.setdefault(chrom,len(chrom_names))
+        parts["chr"].append(chunk[cols["chr"]].map(chrom_names).to_numpy(dtype=np.int16))
+        parts["pos"].append(chunk[cols["pos"]].to_numpy(dtype=np.int64))
+        parts["ref"].append(_encode_alleles(chunk[cols["ref"]],allele_vocab))
+        parts["alt"].append(_encode_alleles(chunk[cols["alt"]],allele_vocab))
+        for field in ("beta","pval","se"):
+            parts[field].append(_parse_floats(chunk[cols[field]]))
+    arrays={field:np.concatenate(parts[field]) if parts[field] else np.array([]) for field in INDEX_FIELDS}
+    order=np.lexsort((arrays["pos"],arrays["chr"]))
+    os.makedirs(index_path,exist_ok=True)
+    for field in INDEX_FIELDS:
+        np.save(os.path.join(index_path,"{}.npy".format(field)),arrays[field][order])
+    #alleles are stored as one byte blob with offsets
+    encoded=[allele.encode() for allele in allele_vocab]
+    offsets=np.zeros(len(encoded)+1,dtype=np.int64)
+    offsets[1:]=np.cumsum([len(a) for a in encoded])
+    np.save(os.path.join(index_path,"allele_offsets.npy"),offsets)
+    with open(os.path.join(index_path,"alleles.bin"),"wb") as f:
+        f.write(b"".join(encoded))
+    chrom_codes=arrays["chr"][order]
+    meta={"version":INDEX_VERSION,
+        "source":os.path.basename(fg_summary),
+        "source_size":identity["size"],
+        "source_mtime":identity["mtime"],
+        "columns":list(columns),
+        "chroms":{name:[int(np.searchsorted(chrom_codes,code,"left")),int(np.searchsorted(chrom_codes,code,"right"))] for name,code in chrom_names.items()}}
+    #meta is written last, so an interrupted build is never picked up as a valid index
+    with open(os.path.join(index_path,"meta.json"),"w") as f:
+        json.dump(meta,f)
+    return index_path
+
+class FGIndex:
+    """Memory-mapped binary index of an fg summary"""
+    def __init__(self, index_path: str, meta: Dict):
+        self.path=index_path
+        self.columns=meta["columns"]
+        self.chroms=meta["chroms"]
+        self.arrays={field:np.load(os.path.join(index_path,"{}.npy".format(field)),mmap_mode="r") for field in INDEX_FIELDS}
+        self.allele_offsets=np.load(os.path.join(index_path,"allele_offsets.npy"))
+        self.allele_data=np.memmap(os.path.join(index_path,"alleles.bin"),dtype=np.uint8,mode="r") if self.allele_offsets[-1] > 0 else np.zeros(0,dtype=np.uint8)
+
+    def _decode_alleles(self, codes: "np.ndarray") -> "np.ndarray":
+        uniq,inverse=np.unique(codes,return_inverse=True)
+        decoded=np.array([bytes(self.allele_data[self.allele_offsets[c]:self.allele_offsets[c+1]]).decode() for c in uniq],dtype=object)
+        return decoded[inverse.reshape(-1)] if uniq.size else np.array([],dtype=object)
+
+    def lookup(self, wanted: Dict[str,"np.ndarray"]) -> "pd.DataFrame":
+        """Fetch variants at wanted positions with searchsorted joins
+        In: dict of chromosome -> sorted unique positions
+        Out: dataframe with the fg columns of matching variants
+        """
+        rows=[]
+        chrom_labels=[]
+        for chrom,positions in wanted.items():
+            if chrom not in self.chroms:
+                continue
+            start,end=self.chroms[chrom]
+            chrom_pos=self.arrays["pos"][start:end]
+            left=np.searchsorted(chrom_pos,positions,"left")
+            right=np.searchsorted(chrom_pos,positions,"right")
+            counts=right-left
+            #expand [left,right) ranges into row indices
+            idx=np.repeat(left-np.cumsum(counts)+counts,counts)+np.arange(counts.sum())
+            rows.append(idx+start)
+            chrom_labels.append(np.full(idx.size,chrom,dtype=object))
+        idx=np.concatenate(rows) if rows else np.array([],dtype=np.int64)
+        cols=dict(zip(INDEX_FIELDS,self.columns))
+        data=pd.DataFrame({
+            cols["chr"]:np.concatenate(chrom_labels) if chrom_labels else np.array([],dtype=object),
+            cols["pos"]:self.arrays["pos"][idx].astype(str).astype(object),
+            cols["ref"]:self._decode_alleles(self.arrays["ref"][idx]),
+            cols["alt"]:self._decode_alleles(self.arrays["alt"][idx]),
+            cols["beta"]:np.asarray(self.arrays["beta"][idx]),
+            cols["pval"]:np.asarray(self.arrays["pval"][idx]),
+            cols["se"]:np.asarray(self.arrays["se"][idx])})
+        return data
+
+def open_index(fg_summary: str, columns: List[str], index_dir: Optional[str]=None) -> Optional[FGIndex]:
+    """Open the index of an fg file if it exists and is up to date
+    In: fg file path, fg column names, optional folder containing indexes
+    Out: FGIndex, or None if there is no usable index
+    """
+    index_path=index_path_for(fg_summary,index_dir)
+    meta_path=os.path.join(index_path,"meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta=json.load(f)
+    identity=source_identity(fg_summary)
+    if meta.get("version") != INDEX_VERSION or meta["source_size"] != identity["size"] or meta["source_mtime"] != identity["mtime"]:
+        print("Index {} is stale, falling back to tabix for {}".format(index_path,fg_summary))
+        return None
+    if meta["columns"] != list(columns):
+        print("Index {} was built for columns {}, falling back to tabix for {}".format(index_path," ".join(meta["columns"]),fg_summary))
+        return None
+    return FGIndex(index_path,meta)
@@ -0,0 +1,159 @@
+#! /usr/bin/env python3
+"""Bulk lookup of variants from FinnGen summary statistics.
+Variants are either fetched with coalesced tabix region queries, or with a single streaming merge-join over the whole file.
+"""
+import csv
+from operator import itemgetter
+from typing import Callable, List, Dict, Tuple, Optional
+import tabix
+
+from lazy import lazy_import
+from metrics import count
+np=lazy_import("numpy") #type: ignore
+pd=lazy_import("pandas") #type: ignore
+
+LOOKUP_STRATEGIES=("auto","region","stream","index")
+#variants closer than this are fetched with the same tabix query
+MAX_GAP=1000
+#above this many variants, auto strategy streams through the whole file instead of seeking
+STREAM_THRESHOLD=200000
+STREAM_CHUNKSIZE=100000
+#rows of region queries kept as text before they are converted
+REGION_BATCH=20000
+
+def pytabix(tb,chrom,start,end):
+    """Get genomic region from tabixed file
+    In: pytabix handle, chromosome, start of region, end of region
+    Out: list of variants in region
+    """
+    try:
+        retval=tb.querys("{}:{}-{}".format(chrom,start,end))
+        return list(retval)
+    except tabix.TabixError:
+        return []
+
+def variant_positions(chroms: "pd.Series", positions: "pd.Series") -> Dict[str,"np.ndarray"]:
+    """Group variant positions by chromosome
+    In: chromosome column, position column
+    Out: dict of chromosome -> sorted unique positions. Unparseable positions are dropped.
+    """
+    pos=pd.to_numeric(positions,errors="coerce")
+    keep=pos.notna().to_numpy() & chroms.notna().to_numpy()
+    data=pd.DataFrame({"chr":chroms.to_numpy()[keep].astype(str),"pos":pos.to_numpy()[keep].astype(np.int64)})
+    return {c:np.unique(grp["pos"].to_numpy()) for c,grp in data.groupby("chr",sort=False)}
+
+def coalesce_regions(positions: "np.ndarray", max_gap: int=MAX_GAP) -> List[Tuple[int,int]]:
+    """Merge sorted positions into regions
+    In: sorted positions, max distance between positions in the same region
+    Out: list of (start,end) tuples
+    """
+    if positions.size == 0:
+        return []
+    breaks=np.flatnonzero(np.diff(positions) > max_gap)
+    starts=positions[np.concatenate(([0],breaks+1))]
+    ends=positions[np.concatenate((breaks,[positions.size-1]))]
+    return list(zip(starts.tolist(),ends.tolist()))
+
+def _frame(parts: List["pd.DataFrame"], columns: List[str]) -> "pd.DataFrame":
+    if not parts:
+        return pd.DataFrame([],columns=columns)
+    return pd.concat(parts,ignore_index=True) if len(parts) > 1 else parts[0]
+
+def region_lookup(tb, header: List[str], wanted: Dict[str,"np.ndarray"], pos_col: str, max_gap: int=MAX_GAP, stats: Optional[Dict]=None,
+        fields: Optional[List[str]]=None, convert: Optional[Callable[["pd.DataFrame"],"pd.DataFrame"]]=None) -> "pd.DataFrame":
+    """Fetch variants with coalesced tabix queries
+    In: pytabix handle, header of fg file, dict of chromosome -> sorted positions, position column name, max gap between positions in a region, optional dict that is filled with counts,
+        optional columns to keep, optional function applied to every batch of rows as it is read
+    Out: dataframe of fg rows at the wanted positions, all columns as strings unless converted
+    """
+    pos_idx=header.index(pos_col)
+    if fields is None:
+        fields=list(header)
+        keep=lambda r: r
+    else:
+        idx=[header.index(field) for field in fields]
+        keep=itemgetter(*idx) if len(idx) > 1 else lambda r: (r[idx[0]],)
+    parts=[]
+    rows=[]
+    def flush():
+        part=pd.DataFrame(rows,columns=fields)
+        parts.append(convert(part) if convert is not None else part)
+        rows.clear()
+    for chrom,positions in wanted.items():
+        position_set=set(positions.tolist())
+        regions=coalesce_regions(positions,max_gap)
+        count(stats,"tabix_queries",len(regions))
+        for start,end in regions:
+            region=pytabix(tb,chrom,start,end)
+            if start == end:
+                rows.extend(map(keep,region))
+            else:
+                rows.extend(keep(r) for r in region if int(r[pos_idx]) in position_set)
+            if len(rows) >= REGION_BATCH:
+                flush()
+    if rows or not parts:
+        flush()
+    return _frame(parts,fields)
+
+def stream_lookup(fg_summary: str, header: List[str], wanted: Dict[str,"np.ndarray"], chr_col: str, pos_col: str, chunksize: int=STREAM_CHUNKSIZE,
+        fields: Optional[List[str]]=None, convert: Optional[Callable[["pd.DataFrame"],"pd.DataFrame"]]=None) -> "pd.DataFrame":
+    """Fetch variants with one sequential pass over the fg file.
+    The file is sorted by position within each chromosome, so every chunk is merge-joined against the sorted wanted positions.
+    In: fg file path, header of fg file, dict of chromosome -> sorted positions, chromosome column name, position column name, rows per chunk,
+        optional columns to keep (they have to include the chromosome and position columns), optional function applied to the rows found in every chunk
+    Out: dataframe of fg rows at the wanted positions, all columns as strings unless converted
+    """
+    out=[]
+    remaining=set(wanted.keys())
+    fields=list(header) if fields is None else list(fields)
+    usecols=sorted(header.index(field) for field in fields)
+    reader=pd.read_csv(fg_summary,sep="\t",dtype=str,na_filter=False,quoting=csv.QUOTE_NONE,chunksize=chunksize,usecols=usecols)
+    for chunk in reader:
+        chunk.columns=[header[i] for i in usecols]
+        chunk_chroms=chunk[chr_col].to_numpy()
+        chunk_pos=pd.to_numeric(chunk[pos_col],errors="coerce").to_numpy()
+        hit=np.zeros(chunk.shape[0],dtype=bool)
+        for chrom in pd.unique(chunk_chroms):
+            if chrom not in wanted:
+                continue
+            in_chrom=chunk_chroms == chrom
+            positions=wanted[chrom]
+            idx=np.searchsorted(positions,chunk_pos[in_chrom])
+            found=positions[np.minimum(idx,positions.size-1)] == chunk_pos[in_chrom]
+            hit[np.flatnonzero(in_chrom)[found]]=True
+        if hit.any():
+            part=chunk.loc[hit,fields]
+            out.append(convert(part) if convert is not None else part)
+        #chromosomes are contiguous in the file, so a chromosome is done once the chunk ends on another one
+        last_chrom=chunk_chroms[-1]
+        remaining-=set(pd.unique(chunk_chroms))-{last_chrom}
+        if not remaining:
+            break
+    reader.close()
+    if not out:
+        empty=pd.DataFrame([],columns=fields)
+        return convert(empty) if convert is not None else empty
+    return _frame(out,fields)
+
+def lookup_fg(fg_summary: str, tb, header: List[str], chroms: "pd.Series", positions: "pd.Series", chr_col: str, pos_col: str, strategy: str="auto", index=None, stats: Optional[Dict]=None, stream_threshold: Optional[int]=STREAM_THRESHOLD,
+        fields: Optional[List[str]]=None, convert: Optional[Callable[["pd.DataFrame"],"pd.DataFrame"]]=None) -> "pd.DataFrame":
+    """Fetch fg rows matching variant positions
+    In: fg file path, pytabix handle (can be None for stream strategy), header of fg file, chromosome column, position column, fg chromosome column name, fg position column name, lookup strategy, optional binary index of the fg file, optional dict that is filled with counts,
+        number of variants above which the auto strategy streams, None to never stream,
+        optional columns to keep, optional function applied to the rows as they are read. Text lookups only keep fields and convert them batch by batch, so the whole text table is never held at once.
+    Out: dataframe of fg rows at the wanted positions, all columns as strings unless converted. With an index, only the indexed columns are returned, with typed values.
+    """
+    if strategy not in LOOKUP_STRATEGIES:
+        raise ValueError("Unknown lookup strategy {}. Use one of {}".format(strategy,", ".join(LOOKUP_STRATEGIES)))
+    wanted=variant_positions(chroms,positions)
+    if index is not None:
+        data=index.lookup(wanted)
+        return convert(data) if convert is not None else data
+    if strategy == "index":
+        raise FileNotFoundError("No up to date binary index found for file {}. Create one with betamatch.py index.".format(fg_summary))
+    if strategy == "auto":
+        n_variants=sum(p.size for p in wanted.values())
+        strategy="stream" if stream_threshold is not None and n_variants > stream_threshold else "region"
+    if strategy == "stream":
+        return stream_lookup(fg_summary,header,wanted,chr_col,pos_col,fields=fields,convert=convert)
+    return region_lookup(tb,header,wanted,pos_col,stats=stats,fields=fields,convert=convert)
@@ -0,0 +1,99 @@
+#! /usr/bin/env python3
+"""Columnar allele harmonization.
+All functions work on whole pandas columns at once instead of row-wise apply calls.
+"""
+from typing import Tuple
+from lazy import lazy_import
+np=lazy_import("numpy") #type: ignore
+pd=lazy_import("pandas") #type: ignore
+
+VALID_ALLELE='^[acgtACGT]+$'
+#strand flip table. A is never present when flipping, so it is not in the table.
+STRAND_FLIP=str.maketrans({"T":"A","C":"G","G":"C"})
+#alleles of up to PACKED_ALLELE_LEN nucleotides are packed into one int64, 3 bits per nucleotide
+PACKED_ALLELE_LEN=21
+PACKED_ALLELE='^[ACGT]{{1,{}}}$'.format(PACKED_ALLELE_LEN)
+NO_ALLELE=-1
+
+def valid_alleles(alleles: "pd.Series") -> "pd.Series":
+    """Check which alleles consist only of nucleotides
+    In: allele column
+    Out: boolean column, True for valid alleles
+    """
+    return alleles.str.match(VALID_ALLELE,na=False).astype(bool)
+
+def flip_unified_strand(ref: "pd.Series", alt: "pd.Series") -> Tuple["pd.Series","pd.Series"]:
+    """Flips alleles to the A strand if necessary.
+    Variants where neither allele contains an A are mapped to the complementary strand.
+    In: ref column, alt column
+    Out: tuple of flipped ref and alt columns
+    """
+    keep = (ref+alt).str.contains("[Aa]",regex=True)
+    flip_ref = ref.str.upper().str.translate(STRAND_FLIP)
+    flip_alt = alt.str.upper().str.translate(STRAND_FLIP)
+    return (ref.where(keep,flip_ref),alt.where(keep,flip_alt))
+
+def sort_alleles(ref: "pd.Series", alt: "pd.Series", beta: "pd.Series") -> Tuple["pd.Series","pd.Series","pd.Series"]:
+    """Order alleles lexicographically, flipping beta sign for swapped variants
+    In: ref column, alt column, beta column
+    Out: tuple of sorted ref, sorted alt and beta columns
+    """
+    swap = (ref > alt).to_numpy(dtype=bool)
+    sorted_ref = ref.where(~swap,alt)
+    sorted_alt = alt.where(~swap,ref)
+    sorted_beta = beta*np.where(swap,-1,1)
+    return (sorted_ref,sorted_alt,sorted_beta)
+
+def flip_beta(ref: "pd.Series", alt: "pd.Series", beta1: "pd.Series", beta2: "pd.Series") -> Tuple["pd.Series","pd.Series","pd.Series","pd.Series"]:
+    """Flip betas (and consequently alleles) of variants where beta1 < 0
+    In: ref column, alt column, beta1 column, beta2 column
+    Out: tuple of ref, alt, beta1, beta2 columns
+    """
+    flip = (beta1 < 0).to_numpy(dtype=bool)
+    return (ref.where(~flip,alt),
+        alt.where(~flip,ref),
+        beta1.where(~flip,-beta1),
+        beta2.where(~flip,-beta2))
+
+def harmonize(data: "pd.DataFrame", ref: str, alt: str, beta: str, prefix: str="unif_") -> "pd.DataFrame":
+    """Add unified allele and beta columns to a dataframe.
+    Alleles are flipped to the A strand and ordered lexicographically, and beta is flipped accordingly.
+    In: dataframe, ref column, alt column, beta column, prefix for unified columns
+    Out: dataframe with unified ref, alt and beta columns
+    """
+    unif_ref, unif_alt = flip_unified_strand(data[ref],data[alt])
+    unif_ref, unif_alt, unif_beta = sort_alleles(unif_ref,unif_alt,data[beta])
+    data["{}ref".format(prefix)]=unif_ref
+    data["{}alt".format(prefix)]=unif_alt
+    data["{}beta".format(prefix)]=unif_beta
+    return data
+
+def _pack_alleles(alleles: "np.ndarray") -> "np.ndarray":
+    """Pack short uppercase alleles into integers, nucleotide i in bits 3i..3i+2 with A=1, C=2, G=3, T=4"""
+    codes=np.zeros(256,dtype=np.int64)
+    codes[np.frombuffer(b"ACGT",dtype=np.uint8)]=np.arange(1,5)
+    raw=np.array(alleles.tolist(),dtype=bytes)
+    width=raw.dtype.itemsize
+    raw=raw.view(np.uint8).reshape(-1,width)
+    #one nucleotide at a time, so that temporaries stay the size of the output
+    packed=np.zeros(raw.shape[0],dtype=np.int64)
+    for i in range(width):
+        packed|=codes[raw[:,i]] << (3*i)
+    return packed
+
+def encode_alleles(left: "pd.Series", right: "pd.Series") -> Tuple["np.ndarray","np.ndarray"]:
+    """Encode two allele columns as integers, so that equal alleles get equal codes.
+    Alleles of up to PACKED_ALLELE_LEN nucleotides are packed bitwise. Longer or other alleles are numbered jointly over
+    both columns with codes below NO_ALLELE, and missing alleles are NO_ALLELE, which never equals another allele.
+    In: allele column, allele column
+    Out: tuple of int64 code arrays
+    """
+    values=np.concatenate([left.to_numpy(dtype=object),right.to_numpy(dtype=object)])
+    out=np.full(values.size,NO_ALLELE,dtype=np.int64)
+    missing=pd.isna(values)
+    packed=pd.Series(values).str.match(PACKED_ALLELE,na=False).to_numpy(dtype=bool)
+    out[packed]=_pack_alleles(values[packed])
+    other=~(packed | missing)
+    if other.any():
+        out[other]=NO_ALLELE-1-pd.factorize(values[other])[0]
+    return (out[:left.size],out[left.size:])
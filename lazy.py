@@ -0,0 +1,29 @@
+#! /usr/bin/env python3
+"""Lazy imports of heavy modules.
+A lazily imported module is only executed when one of its attributes is first used, so command line help and
+code paths that do not need pandas, scipy or plotnine start without loading them.
+Set BETAMATCH_EAGER_IMPORTS=1 to import everything up front, e.g. to compare startup times.
+"""
+import importlib, importlib.util, os, sys
+
+EAGER=os.environ.get("BETAMATCH_EAGER_IMPORTS","") not in ("","0")
+
+def lazy_import(name: str):
+    """Import a module lazily
+    In: module name
+    Out: module, executed on first attribute access
+    """
+    if name in sys.modules:
+        #importlib.import_module would touch the module and execute a lazy one
+        return sys.modules[name]
+    if EAGER:
+        return importlib.import_module(name)
+    spec=importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named '{}'".format(name),name=name)
+    loader=importlib.util.LazyLoader(spec.loader)
+    spec.loader=loader
+    module=importlib.util.module_from_spec(spec)
+    sys.modules[name]=module
+    loader.exec_module(module)
+    return module
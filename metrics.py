@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+"""Stage timings and counters for match file pairs."""
+import json, resource, sys, time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+@contextmanager
+def timed(stats: Optional[Dict], stage: str):
+    """Add the wall time of a block to stats["seconds"][stage]. Does nothing if stats is None."""
+    if stats is None:
+        yield
+        return
+    start=time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds=stats.setdefault("seconds",OrderedDict())
+        seconds[stage]=seconds.get(stage,0.0)+time.perf_counter()-start
+
+def count(stats: Optional[Dict], name: str, n):
+    """Add n to the counter stats[name]. Does nothing if stats is None."""
+    if stats is not None:
+        stats[name]=stats.get(name,0)+int(n)
+
+def timed_iter(iterable, stats: Optional[Dict], stage: str):
+    """Iterate, timing the production of every item as stage"""
+    iterator=iter(iterable)
+    while True:
+        with timed(stats,stage):
+            try:
+                item=next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+def write_metrics(path: str, records: List[Dict]):
+    """Write metrics records as json lines"""
+    with open(path,"w") as f:
+        for record in records:
+            f.write(json.dumps(record)+"\n")
+
+def peak_rss_mb() -> float:
+    """Peak resident set size in MB of this process or of its largest finished worker process"""
+    peak=max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    #ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak/(1<<20) if sys.platform == "darwin" else peak/(1<<10)
+
+def summarize(records: List[Dict], wall_time: float, peak_rss: Optional[float]=None) -> str:
+    """Run level summary of metrics records
+    In: list of pair metrics records, wall time of the run, optional peak resident set size in MB
+    Out: summary text. Stage times of cached records are from the run that computed them, so they are left out of the stage totals and of fg_opens. Other counters of cached records are included.
+    """
+    ext_seconds=OrderedDict()
+    pair_seconds=OrderedDict()
+    seen_ext=set()
+    timed_ext=set()
+    totals=OrderedDict((name,0) for name in ("ext_rows","invalid_alleles","se_imputed","fg_opens","tabix_queries","fg_rows","output_rows","matched_rows","output_bytes"))
+    for record in records:
+        #external summary stages and counts are shared by all pairs of the same external file
+        if record["ext"] not in seen_ext:
+            seen_ext.add(record["ext"])
+            for name in ("ext_rows","invalid_alleles","se_imputed"):
+                totals[name]+=record[name]
+        if not record.get("cached"):
+            if record["ext"] not in timed_ext:
+                timed_ext.add(record["ext"])
+                for stage,seconds in record["ext_seconds"].items():
+                    ext_seconds[stage]=ext_seconds.get(stage,0.0)+seconds
+            for stage,seconds in record["seconds"].items():
+                pair_seconds[stage]=pair_seconds.get(stage,0.0)+seconds
+            totals["fg_opens"]+=record.get("fg_opens",0)
+        for name in ("tabix_queries","fg_rows","output_rows","matched_rows","output_bytes"):
+            totals[name]+=record[name]
+    n_cached=sum(1 for record in records if record.get("cached"))
+    lines=["Run summary: {} pairs ({} cached), {} external files, {:.2f} s wall time".format(len(records),n_cached,len(seen_ext),wall_time)]
+    for stage,seconds in list(ext_seconds.items())+list(pair_seconds.items()):
+        lines.append("  {:<20}{:>10.2f} s".format(stage,seconds))
+    for name,value in totals.items():
+        lines.append("  {:<20}{:>10}".format(name,value))
+    if totals["output_rows"] > 0:
+        lines.append("  {:<20}{:>10.3f}".format("match_rate",totals["matched_rows"]/totals["output_rows"]))
+    if peak_rss is not None:
+        lines.append("  {:<20}{:>10.1f}".format("peak_rss_mb",peak_rss))
+    return "\n".join(lines)
@@ -0,0 +1,126 @@
+#! /usr/bin/env python3
+"""Content-addressed cache of per-pair matching results.
+An entry holds the matched table, the r2 table row and the metrics record of one pair, keyed by a hash of everything that
+determines them: the external file contents, the identity of the finngen file, the column names, the p-value filter and the output format.
+"""
+import hashlib, json, os, shutil, tempfile, time
+from typing import Dict, List, Optional, Tuple
+
+CACHE_VERSION=1
+HASH_BLOCK=1<<20
+
+def default_cache_dir() -> str:
+    """Cache folder used when --cache-dir is not given"""
+    return os.path.join(os.environ.get("XDG_CACHE_HOME",os.path.join(os.path.expanduser("~"),".cache")),"betamatch")
+
+def file_digest(path: str) -> str:
+    """sha256 of the contents of a file"""
+    digest=hashlib.sha256()
+    with open(path,"rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK),b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def fg_identity(fg_path: str) -> Dict:
+    """Identity of an fg file without reading it through.
+    The tabix index changes whenever the contents do, so its digest identifies the file also after it has been copied to a new place.
+    """
+    identity={"name":os.path.basename(fg_path),"size":os.path.getsize(fg_path)}
+    tbi_path=fg_path+".tbi"
+    if os.path.exists(tbi_path):
+        identity["tbi"]=file_digest(tbi_path)
+    else:
+        identity["mtime"]=os.path.getmtime(fg_path)
+    return identity
+
+class ResultCache:
+    """Folder of cached pair results, evicted by total size and age"""
+    def __init__(self, cache_dir: str, max_bytes: Optional[int]=None, max_age_days: Optional[float]=None):
+        self.cache_dir=cache_dir
+        self.max_bytes=max_bytes
+        self.max_age_days=max_age_days
+        self._ext_digests={}
+        os.makedirs(cache_dir,exist_ok=True)
+
+    def key(self, ext_path: str, fg_path: str, settings: Dict) -> str:
+        """Cache key of a pair
+        In: ext fpath, fg fpath, json serializable settings that change the results
+        Out: hex digest
+        """
+        if ext_path not in self._ext_digests:
+            self._ext_digests[ext_path]=file_digest(ext_path)
+        spec={"version":CACHE_VERSION,"ext":self._ext_digests[ext_path],"fg":fg_identity(fg_path),"settings":settings}
+        return hashlib.sha256(json.dumps(spec,sort_keys=True).encode()).hexdigest()
+
+    def _entry(self, key: str) -> str:
+        return os.path.join(self.cache_dir,key[:2],key)
+
+    def get(self, key: str, out_path: str) -> Optional[Tuple[Optional[Dict],Dict]]:
+        """Copy a cached matched table to out_path
+        In: cache key, output file path
+        Out: tuple of cached r2 table row and metrics record, or None if the pair is not cached
+        """
+        entry=self._entry(key)
+        meta_path=os.path.join(entry,"result.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            result=json.load(f)
+        shutil.copyfile(os.path.join(entry,"table"),out_path)
+        #entries are evicted least recently used first
+        os.utime(entry)
+        return (result["row"],result["record"])
+
+    def put(self, key: str, out_path: str, row: Optional[Dict], record: Dict):
+        """Store the results of a pair. The entry appears atomically, so concurrent runs never see a partial entry.
+        In: cache key, matched table path, r2 table row, metrics record
+        """
+        entry=self._entry(key)
+        if os.path.exists(entry):
+            return
+        os.makedirs(os.path.dirname(entry),exist_ok=True)
+        tmp=tempfile.mkdtemp(prefix=".tmp_",dir=os.path.dirname(entry))
+        try:
+            shutil.copyfile(out_path,os.path.join(tmp,"table"))
+            with open(os.path.join(tmp,"result.json"),"w") as f:
+                json.dump({"row":row,"record":record},f)
+            os.rename(tmp,entry)
+        except OSError:
+            shutil.rmtree(tmp,ignore_errors=True)
+            if not os.path.exists(entry):
+                raise
+
+    def entries(self) -> List[Tuple[str,float,int]]:
+        """List cache entries
+        Out: list of (entry path, last use time, size in bytes) tuples
+        """
+        out=[]
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir=os.path.join(self.cache_dir,prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                entry=os.path.join(prefix_dir,name)
+                if name.startswith(".tmp_"):
+                    continue
+                size=sum(os.path.getsize(os.path.join(entry,f)) for f in os.listdir(entry))
+                out.append((entry,os.path.getmtime(entry),size))
+        return out
+
+    def evict(self) -> int:
+        """Remove entries older than max_age_days, then least recently used entries until the cache fits in max_bytes
+        Out: number of removed entries
+        """
+        entries=sorted(self.entries(),key=lambda e: e[1])
+        now=time.time()
+        removed=0
+        total=sum(size for _,_,size in entries)
+        for entry,used,size in entries:
+            too_old=self.max_age_days is not None and now-used > self.max_age_days*86400
+            too_big=self.max_bytes is not None and total > self.max_bytes
+            if not (too_old or too_big):
+                continue
+            shutil.rmtree(entry,ignore_errors=True)
+            total-=size
+            removed+=1
+        return removed
@@ -0,0 +1,336 @@
+#! /usr/bin/env python3
+"""Writing and reading matched beta tables as tsv, parquet, feather or bgzipped and tabix indexed tsv.
+Parquet and feather need pyarrow, which is only imported when one of them is used.
+"""
+import gzip, heapq, os, shutil, tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional, Tuple
+from lazy import lazy_import
+from bgzf import BgzfWriter, BLOCK_SIZE, MIN_SHIFT, block_offsets, reg2bin, tabix_index, write_tabix_index
+np=lazy_import("numpy") #type: ignore
+pd=lazy_import("pandas") #type: ignore
+
+OUTPUT_FORMATS=("tsv","parquet","feather","tsv.gz")
+NA_REP="-"
+DEFAULT_COMPRESS_LEVEL=1
+#background threads compressing bgzipped tables, shared by all tables of a process
+COMPRESS_THREADS=2
+_compress_executor=None
+#blocks of a run that may wait for compression before more rows are formatted, about 16 MB of text
+PENDING_BLOCKS=256
+#rows formatted at once when writing a sorted table
+WRITE_ROWS=100000
+
+def table_suffix(fmt: str) -> str:
+    """File suffix of matched beta tables in a format"""
+    return ".betas.{}".format(fmt)
+
+def _pyarrow():
+    try:
+        import pyarrow #type: ignore
+        import pyarrow.feather, pyarrow.ipc, pyarrow.parquet #type: ignore
+    except ImportError:
+        raise ImportError("pyarrow is needed for parquet and feather output. Install it or use --output-format tsv.")
+    return pyarrow
+
+class TsvWriter:
+    """Append dataframes to a tab separated file"""
+    def __init__(self, path: str, header: bool=True):
+        self.path=path
+        self.header=header
+        self.started=False
+
+    def write(self, data: "pd.DataFrame"):
+        data.to_csv(path_or_buf=self.path,mode="a" if self.started else "w",header=self.header and not self.started,index=False,sep="\t",na_rep=NA_REP)
+        self.started=True
+
+    def append_spool(self, spool_path: str):
+        """Append the rows of a spool file written with spool_writer"""
+        with open(self.path,"ab") as out, open(spool_path,"rb") as spool:
+            shutil.copyfileobj(spool,out)
+
+    def close(self):
+        pass
+
+def chrom_sort_key(chrom: str):
+    """Sort key of chromosome names: numbered chromosomes in numeric order, then the others by name, with or without a chr prefix"""
+    name=chrom[3:] if chrom.lower().startswith("chr") else chrom
+    return (0,int(name),chrom) if name.isdigit() else (1,name,chrom)
+
+def compress_executor() -> ThreadPoolExecutor:
+    """Thread pool compressing the blocks of all bgzipped tables of the process, created on first use"""
+    global _compress_executor
+    if _compress_executor is None:
+        _compress_executor=ThreadPoolExecutor(COMPRESS_THREADS)
+    return _compress_executor
+
+def index_table(path: str, chr_col: str, pos_col: str) -> str:
+    """Tabix index a sorted, bgzipped table with one header line
+    In: file path, chromosome column name, position column name
+    Out: index path
+    """
+    with gzip.open(path,"rt") as f:
+        header=f.readline().rstrip("\n").split("\t")
+    return tabix_index(path,header.index(chr_col)+1,header.index(pos_col)+1,None,"#",1)
+
+class SortedRun(NamedTuple):
+    """A sorted, compressed part of a bgzipped table, with what its tabix index needs: for every 16 kb window of a
+    chromosome the uncompressed offsets in the run of the start of its first row and the end of its last row"""
+    path:str
+    first_key:tuple
+    last_key:tuple
+    length:int
+    chroms:"np.ndarray"
+    windows:"np.ndarray"
+    starts:"np.ndarray"
+    ends:"np.ndarray"
+
+class SortedBgzfWriter:
+    """Write dataframes to a bgzipped tab separated file sorted by chromosome and position, and index it with tabix.
+    Every written dataframe is sorted and handed to background threads that compress it into a run, a BGZF file in a
+    temporary folder, while the caller goes on matching. When every run starts at or after the end of the previous one,
+    as for a single dataframe or for chunks of a position sorted file, close concatenates the compressed blocks of the
+    runs and builds the tabix index from the row offsets recorded while writing them. Otherwise the runs are merged line
+    by line and the merged file is indexed.
+    Rows at the same position keep the order they were written in, except that rows with a value in last_col come after
+    the rows without one. Rows without a chromosome or an integer position are written last.
+    """
+    def __init__(self, path: str, chr_col: str, pos_col: str, last_col: Optional[str]=None, level: int=DEFAULT_COMPRESS_LEVEL):
+        self.path=path
+        self.chr_col=chr_col
+        self.pos_col=pos_col
+        self.last_col=last_col
+        self.level=level
+        self.columns=None
+        self.header=""
+        self.runs=[]
+        self.run_writer=None
+        #formatted rows without coordinates, without and with a value in last_col
+        self.unplaced=([],[])
+        self.n_unplaced=0
+        self.spool_dir=None
+
+    def _keys(self, data: "pd.DataFrame") -> Tuple["np.ndarray","np.ndarray","np.ndarray"]:
+        """Positions, mask of rows with coordinates and mask of rows with a value in last_col"""
+        pos=pd.to_numeric(data[self.pos_col],errors="coerce").to_numpy(dtype=np.float64)
+        has_coord=data[self.chr_col].notna().to_numpy() & ~np.isnan(pos)
+        has_coord[has_coord]=pos[has_coord] % 1 == 0
+        if self.last_col is None:
+            return (pos,has_coord,np.zeros(data.shape[0],dtype=bool))
+        #spooled tables are read back as text, with missing values as NA_REP
+        last=(data[self.last_col].notna() & (data[self.last_col] != NA_REP)).to_numpy()
+        return (pos,has_coord,last)
+
+    def write(self, data: "pd.DataFrame"):
+        if self.columns is None:
+            self.columns=list(data.columns)
+            self.header=data.iloc[:0].to_csv(sep="\t",index=False)
+            self.spool_dir=tempfile.mkdtemp(prefix=".sort_",dir=os.path.dirname(os.path.abspath(self.path)))
+        pos,has_coord,last=self._keys(data)
+        for unplaced,rows in zip(self.unplaced,(~has_coord & ~last,~has_coord & last)):
+            if rows.any():
+                unplaced.append(data[rows].to_csv(sep="\t",header=False,index=False,na_rep=NA_REP))
+        self.n_unplaced+=np.count_nonzero(~has_coord)
+        if not has_coord.any():
+            return
+        rows=np.flatnonzero(has_coord)
+        chroms=data[self.chr_col].to_numpy(dtype=object)[rows].astype(str)
+        names,codes=np.unique(chroms,return_inverse=True)
+        ranks=np.empty(names.size,dtype=np.int64)
+        ranks[sorted(range(names.size),key=lambda i: chrom_sort_key(names[i]))]=np.arange(names.size)
+        order=np.lexsort((np.arange(rows.size),last[rows],pos[rows],ranks[codes]))
+        rows=rows[order]
+        codes=codes[order]
+        self._finish_run()
+        run_path=os.path.join(self.spool_dir,"{}.gz".format(len(self.runs)))
+        self.run_writer=BgzfWriter(run_path,self.level,executor=compress_executor(),max_pending=PENDING_BLOCKS)
+        line_ends=[]
+        length=0
+        for start in range(0,rows.size,WRITE_ROWS):
+            text=data.iloc[rows[start:start+WRITE_ROWS]].to_csv(sep="\t",header=False,index=False,na_rep=NA_REP).encode()
+            self.run_writer.write(text)
+            line_ends.append(np.flatnonzero(np.frombuffer(text,dtype=np.uint8) == ord("\n"))+1+length)
+            length+=len(text)
+        line_ends=np.concatenate(line_ends)
+        windows=np.maximum(pos[rows].astype(np.int64)-1,0) >> MIN_SHIFT
+        first=np.flatnonzero(np.concatenate(([True],(codes[1:] != codes[:-1]) | (windows[1:] != windows[:-1]))))
+        self.runs.append(SortedRun(run_path,(chrom_sort_key(names[codes[0]]),pos[rows[0]],last[rows[0]]),
+            (chrom_sort_key(names[codes[-1]]),pos[rows[-1]],last[rows[-1]]),length,names[codes[first]],windows[first],
+            np.concatenate(([0],line_ends[:-1]))[first],line_ends[np.concatenate((first[1:]-1,[rows.size-1]))]))
+
+    def _finish_run(self):
+        if self.run_writer is not None:
+            self.run_writer.close()
+            self.run_writer=None
+
+    def _line_key(self, line: bytes):
+        fields=line.rstrip(b"\n").split(b"\t")
+        last=self.last_col is not None and fields[self.columns.index(self.last_col)] != NA_REP.encode()
+        return (chrom_sort_key(fields[self.columns.index(self.chr_col)].decode()),float(fields[self.columns.index(self.pos_col)]),last)
+
+    def _merge_runs(self, f: BgzfWriter):
+        """Merge overlapping runs line by line into f. heapq.merge takes equal lines from earlier runs first, so the order stays stable."""
+        runs=[gzip.open(run.path,"rb") for run in self.runs]
+        try:
+            lines=[]
+            for line in heapq.merge(*runs,key=self._line_key):
+                lines.append(line)
+                if len(lines) >= WRITE_ROWS:
+                    f.write(b"".join(lines))
+                    lines=[]
+            f.write(b"".join(lines))
+        finally:
+            for run in runs:
+                run.close()
+
+    def append_spool(self, spool_path: str):
+        """Add the rows of a spool file written with spool_writer"""
+        if os.path.getsize(spool_path) == 0:
+            return
+        for chunk in pd.read_csv(spool_path,sep="\t",header=None,names=self.columns,dtype=str,na_filter=False,chunksize=WRITE_ROWS):
+            self.write(chunk)
+
+    def _write_index(self, run_offsets: List[int]):
+        """Tabix index of concatenated runs
+        In: compressed offsets of the runs in the output, and of the end of the last run
+        """
+        names=OrderedDict()
+        bins=[]
+        linear=[]
+        for run,offset,next_offset in zip(self.runs,run_offsets,run_offsets[1:]):
+            blocks=np.array(block_offsets(run.path),dtype=np.int64)+offset
+            def virtual_offsets(pos):
+                #the end of a run is the start of the next block
+                voffs=(blocks[np.minimum(pos//BLOCK_SIZE,blocks.size-1)] << 16) | (pos % BLOCK_SIZE)
+                return np.where(pos >= run.length,next_offset << 16,voffs)
+            for chrom,window,beg,end in zip(run.chroms.tolist(),run.windows.tolist(),virtual_offsets(run.starts).tolist(),virtual_offsets(run.ends).tolist()):
+                if chrom not in names:
+                    names[chrom]=len(names)
+                    bins.append(OrderedDict())
+                    linear.append([])
+                tid=names[chrom]
+                chunks=bins[tid].setdefault(reg2bin(window << MIN_SHIFT,(window << MIN_SHIFT)+1),[])
+                if chunks and chunks[-1][1] == beg:
+                    chunks[-1][1]=end
+                else:
+                    chunks.append([beg,end])
+                lin=linear[tid]
+                if len(lin) <= window:
+                    lin.extend([None]*(window+1-len(lin)))
+                if lin[window] is None:
+                    lin[window]=beg
+        pos_col=self.columns.index(self.pos_col)+1
+        write_tabix_index(self.path+".tbi",list(names),bins,linear,self.n_unplaced,self.columns.index(self.chr_col)+1,pos_col,pos_col,"#",1)
+
+    def close(self):
+        self._finish_run()
+        in_order=all(previous.last_key <= run.first_key for previous,run in zip(self.runs,self.runs[1:]))
+        run_offsets=[]
+        with BgzfWriter(self.path,self.level,executor=compress_executor()) as f:
+            f.write(self.header)
+            if in_order:
+                for run in self.runs:
+                    f.flush()
+                    run_offsets.append(f.tell() >> 16)
+                    f.append_bgzf(run.path)
+                run_offsets.append(f.tell() >> 16)
+            else:
+                self._merge_runs(f)
+            for unplaced in self.unplaced:
+                for text in unplaced:
+                    f.write(text)
+        if self.columns is not None:
+            if in_order:
+                self._write_index(run_offsets)
+            else:
+                tabix_index(self.path,self.columns.index(self.chr_col)+1,self.columns.index(self.pos_col)+1,None,"#",1)
+        if self.spool_dir is not None:
+            shutil.rmtree(self.spool_dir,ignore_errors=True)
+
+class ArrowWriter:
+    """Append dataframes to a parquet or feather file.
+    The schema is fixed by the first dataframe: text columns are written as strings and int_columns as nullable integers,
+    so that chunks with differently inferred types end up in one table.
+    """
+    def __init__(self, path: str, fmt: str, int_columns: List[str]=()):
+        self.pa=_pyarrow()
+        self.path=path
+        self.fmt=fmt
+        self.int_columns=set(int_columns)
+        self.schema=None
+        self.writer=None
+
+    def _field_type(self, name, dtype):
+        if name in self.int_columns:
+            return self.pa.int64()
+        if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_numeric_dtype(dtype):
+            return self.pa.from_numpy_dtype(getattr(dtype,"numpy_dtype",dtype))
+        return self.pa.string()
+
+    def _table(self, data: "pd.DataFrame"):
+        if self.schema is None:
+            self.schema=self.pa.schema([(name,self._field_type(name,dtype)) for name,dtype in data.dtypes.items()])
+        columns={}
+        for field in self.schema:
+            col=data[field.name]
+            if field.type == self.pa.string():
+                col=col.where(col.isna(),col.astype(str))
+            elif field.name in self.int_columns:
+                col=pd.to_numeric(col,errors="coerce").astype("Int64")
+            columns[field.name]=col
+        return self.pa.Table.from_pandas(pd.DataFrame(columns),schema=self.schema,preserve_index=False)
+
+    def write(self, data: "pd.DataFrame"):
+        table=self._table(data)
+        if self.writer is None:
+            if self.fmt == "parquet":
+                self.writer=self.pa.parquet.ParquetWriter(self.path,self.schema)
+            else:
+                self.writer=self.pa.ipc.new_file(self.path,self.schema)
+        self.writer.write_table(table)
+
+    def append_spool(self, spool_path: str):
+        """Append the rows of a spool file written with spool_writer"""
+        with self.pa.ipc.open_file(spool_path) as spool:
+            self.writer.write_table(spool.read_all().cast(self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+def open_writer(path: str, fmt: str, int_columns: List[str]=(), position: Optional[Tuple[str,str]]=None, compress_level: int=DEFAULT_COMPRESS_LEVEL, last_col: Optional[str]=None):
+    """Writer for a matched beta table
+    In: file path, output format, columns written as integers in binary formats, chromosome and position columns that bgzipped tables are sorted and indexed by, compression level of bgzipped tables,
+        column whose rows with a value come after the others at the same position in bgzipped tables
+    Out: TsvWriter, SortedBgzfWriter or ArrowWriter
+    """
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format {}. Use one of {}".format(fmt,", ".join(OUTPUT_FORMATS)))
+    if fmt == "tsv":
+        return TsvWriter(path)
+    if fmt == "tsv.gz":
+        if position is None:
+            raise ValueError("Chromosome and position columns are needed for bgzipped output")
+        return SortedBgzfWriter(path,position[0],position[1],last_col,compress_level)
+    return ArrowWriter(path,fmt,int_columns)
+
+def spool_writer(path: str, fmt: str, int_columns: List[str]=()):
+    """Writer for rows that are appended to an open_writer table later with append_spool
+    In: spool file path, output format of the final table, columns written as integers in binary formats
+    Out: TsvWriter without header, or ArrowWriter writing feather
+    """
+    if fmt in ("tsv","tsv.gz"):
+        return TsvWriter(path,header=False)
+    return ArrowWriter(path,"feather",int_columns)
+
+def read_table(path: str, columns: Optional[List[str]]=None) -> "pd.DataFrame":
+    """Read a matched beta table written in any of the output formats
+    In: file path, optional list of columns to read
+    Out: dataframe. Missing values of tsv files are NaN.
+    """
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path,columns=columns)
+    if path.endswith(".feather"):
+        return pd.read_feather(path,columns=columns)
+    return pd.read_csv(path,sep="\t",na_values=NA_REP,usecols=columns)
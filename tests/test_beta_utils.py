@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+"""Closed form pair statistics against the statsmodels fits they replaced."""
+import os, sys
+import numpy as np
+import pytest
+
+REPO=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,REPO)
+
+from beta_utils import grouped_regression, grouped_statistics, calculate_regression, weighted_pearsonr
+
+sm=pytest.importorskip("statsmodels.api")
+
+RTOL=1e-9
+
+def random_groups(rng, sizes):
+    """Points of several pairs, with standard errors of x"""
+    groups=np.repeat(np.arange(len(sizes)),sizes)
+    x=rng.normal(0,0.1,groups.size)
+    y=0.8*x+rng.normal(0,0.05,groups.size)
+    stderr=rng.uniform(0.005,0.2,groups.size)
+    return (x,y,stderr,groups)
+
+def reference_fit(x, y, weights=None):
+    """statsmodels regression y=bx without a constant, as calculate_regression computed it before"""
+    model=sm.WLS(y,x,weights) if weights is not None else sm.OLS(y,x)
+    results=model.fit()
+    return (results.params[0],results.bse[0],results.tvalues[0],results.pvalues[0],results.rsquared_adj)
+
+def assert_fit(result, expected):
+    np.testing.assert_allclose(np.array(result,dtype=float),np.array(expected,dtype=float),rtol=RTOL,atol=0)
+
+@pytest.mark.parametrize("weighted",[False,True])
+def test_single_fit(weighted):
+    rng=np.random.default_rng(1)
+    x,y,stderr,_=random_groups(rng,[500])
+    weights=1/stderr**2 if weighted else None
+    assert_fit(calculate_regression(x,y,weights),reference_fit(x,y,weights))
+
+@pytest.mark.parametrize("weighted",[False,True])
+def test_batched_fits(weighted):
+    """Groups fitted together, including groups of 2 points with one residual degree of freedom"""
+    rng=np.random.default_rng(2)
+    sizes=[2,30,2,500,7,2,1000]
+    x,y,stderr,groups=random_groups(rng,sizes)
+    weights=1/stderr**2 if weighted else None
+    results=grouped_regression(x,y,weights,groups,len(sizes))
+    for g in range(len(sizes)):
+        rows=groups == g
+        expected=reference_fit(x[rows],y[rows],weights[rows] if weighted else None)
+        assert_fit([values[g] for values in results],expected)
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_single_point_group():
+    """A group of 1 point has a slope, and NaN where statsmodels divides by zero residual degrees of freedom"""
+    rng=np.random.default_rng(3)
+    x,y,stderr,groups=random_groups(rng,[1,50])
+    results=grouped_regression(x,y,1/stderr**2,groups,2)
+    np.testing.assert_allclose(results.slope[0],reference_fit(x[:1],y[:1],1/stderr[:1]**2)[0],rtol=RTOL)
+    assert all(np.isnan(values[0]) for values in results[1:])
+    assert_fit([values[1] for values in results],reference_fit(x[1:],y[1:],1/stderr[1:]**2))
+
+def test_grouped_statistics():
+    rng=np.random.default_rng(4)
+    sizes=[2,40,300]
+    x,y,stderr,groups=random_groups(rng,sizes)
+    stats=grouped_statistics(x,y,stderr,groups,len(sizes))
+    assert stats.n.tolist() == sizes
+    for g in range(len(sizes)):
+        rows=groups == g
+        np.testing.assert_allclose(stats.r2[g],np.corrcoef(x[rows],y[rows])[0,1]**2,rtol=RTOL)
+        np.testing.assert_allclose(stats.weighted_r2[g],weighted_pearsonr(x[rows],y[rows],1/(stderr[rows]**2+1e-9))**2,rtol=RTOL)
+        assert_fit([values[g] for values in stats.regression],reference_fit(x[rows],y[rows]))
+        assert_fit([values[g] for values in stats.weighted_regression],reference_fit(x[rows],y[rows],1/stderr[rows]**2))
@@ -0,0 +1,112 @@
+#! /usr/bin/env python3
+"""BGZF files and tabix indexes written without htslib give back their rows, and the rows of every queried region."""
+import gzip, os, random, sys
+import pandas as pd
+import tabix
+
+REPO=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,REPO)
+
+from bgzf import BgzfWriter, BLOCK_SIZE, tabix_index
+from table_formats import SortedBgzfWriter, NA_REP, chrom_sort_key
+
+CHROMS=["1","2","10","X"]
+
+def random_table(rng, n):
+    """Rows on several chromosomes over many 16 kb windows, some without an integer position, some with a value in the last column"""
+    rows=[]
+    for i in range(n):
+        pos=str(rng.choice([rng.randint(1,200),rng.randint(1,5000000)]))
+        case=rng.random()
+        if case < 0.03:
+            pos=rng.choice(["NA","1.5",""])
+        chrom=rng.choice(CHROMS) if rng.random() > 0.01 else None
+        rows.append((chrom,pos if pos != "" else None,"row{}".format(i),"YES" if rng.random() < 0.1 else None))
+    return pd.DataFrame(rows,columns=["chr","pos","value","invalid_data"])
+
+def expected_order(data):
+    """Row order of SortedBgzfWriter: by chromosome and position with rows with invalid_data after the others, rows without coordinates last"""
+    pos=pd.to_numeric(data["pos"],errors="coerce")
+    placed=(data["chr"].notna() & pos.notna() & (pos % 1 == 0)).to_numpy()
+    last=data["invalid_data"].notna().to_numpy()
+    keys=[(chrom_sort_key(c),p,l,i) for i,(c,p,l) in enumerate(zip(data["chr"],pos,last)) if placed[i]]
+    return [key[3] for key in sorted(keys)]+[i for i in range(data.shape[0]) if not placed[i] and not last[i]]+[i for i in range(data.shape[0]) if not placed[i] and last[i]]
+
+def expected_text(data):
+    """Text SortedBgzfWriter writes for a table"""
+    return data.iloc[expected_order(data)].to_csv(sep="\t",index=False,na_rep=NA_REP)
+
+def random_regions(rng, n):
+    regions=[]
+    for _ in range(n):
+        beg=rng.choice([rng.randint(1,300),rng.randint(1,5000000)])
+        regions.append((rng.choice(CHROMS),beg,beg+rng.choice([0,10,1000,20000,300000,5000000])))
+    return regions+[("1",1,1),("X",1,10**8),("Y",1,10**8)]
+
+def check_queries(path, data, regions):
+    """Row counts of tabix queries equal a filter of the table"""
+    pos=pd.to_numeric(data["pos"],errors="coerce")
+    tb=tabix.open(path)
+    for chrom,beg,end in regions:
+        expected=((data["chr"] == chrom) & (pos >= beg) & (pos <= end) & (pos % 1 == 0)).sum()
+        try:
+            found=len(list(tb.querys("{}:{}-{}".format(chrom,beg,end))))
+        except tabix.TabixError:
+            found=0
+        assert found == expected, (chrom,beg,end)
+
+def write_sorted(path, chunks):
+    writer=SortedBgzfWriter(path,"chr","pos","invalid_data")
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.close()
+    return writer
+
+def test_tabix_index(tmp_path):
+    rng=random.Random(1)
+    data=random_table(rng,20000)
+    pos=pd.to_numeric(data["pos"],errors="coerce")
+    data=data[(data["chr"].notna() & pos.notna() & (pos % 1 == 0)).to_numpy()].reset_index(drop=True)
+    text=expected_text(data)
+    assert len(text) > 3*BLOCK_SIZE
+    path=str(tmp_path/"table.tsv.gz")
+    with BgzfWriter(path) as f:
+        f.write(text)
+    tabix_index(path,1,2,None,"#",1)
+    with gzip.open(path,"rt") as f:
+        assert f.read() == text
+    check_queries(path,data,random_regions(rng,200))
+
+def test_sorted_runs_in_order(tmp_path):
+    """Chunks of a position sorted table are concatenated and indexed from their run offsets"""
+    rng=random.Random(2)
+    data=random_table(rng,20000)
+    #sorted input, as from a position sorted external summary read in chunks
+    data=data.iloc[expected_order(data)].reset_index(drop=True)
+    text=expected_text(data)
+    path=str(tmp_path/"runs.tsv.gz")
+    writer=write_sorted(path,[data.iloc[i:i+3000] for i in range(0,data.shape[0],3000)])
+    assert len(writer.runs) > 1 and all(a.last_key <= b.first_key for a,b in zip(writer.runs,writer.runs[1:]))
+    with gzip.open(path,"rt") as f:
+        assert f.read() == text
+    check_queries(path,data,random_regions(rng,200))
+
+def test_sorted_runs_overlapping(tmp_path):
+    """Unsorted chunks overlap, so their runs are merged line by line and the merged file is indexed"""
+    rng=random.Random(3)
+    data=random_table(rng,20000)
+    path=str(tmp_path/"merged.tsv.gz")
+    writer=write_sorted(path,[data.iloc[i:i+7000] for i in range(0,data.shape[0],7000)])
+    assert not all(a.last_key <= b.first_key for a,b in zip(writer.runs,writer.runs[1:]))
+    with gzip.open(path,"rt") as f:
+        assert f.read() == expected_text(data)
+    check_queries(path,data,random_regions(rng,200))
+
+def test_single_table(tmp_path):
+    rng=random.Random(4)
+    data=random_table(rng,5000)
+    path=str(tmp_path/"single.tsv.gz")
+    write_sorted(path,[data])
+    with gzip.open(path,"rt") as f:
+        assert f.read() == expected_text(data)
+    check_queries(path,data,random_regions(rng,100))
@@ -0,0 +1,91 @@
+#! /usr/bin/env python3
+"""Lookup strategies give the same matched tables as tabix region queries, to the last digit of every value."""
+import os, random, sys
+
+REPO=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,REPO)
+
+import betamatch, fg_lookup
+from betamatch import ExtCols, FGCols, MatchOptions, main
+from bgzf import BgzfWriter, tabix_index
+from fg_index import build_index
+
+FG_COLS=FGCols("#chrom","pos","ref","alt","beta","pval","sebeta")
+EXT_COLS=ExtCols("chr","pos","ref","alt","beta","pval","se","study_doi")
+CHROMS=("1","2","X")
+
+def write_inputs(folder, n_variants=3000, seed=1):
+    """Write a tabixed fg summary with finngen style p-values down to 1e-300, an external summary and a match file
+    In: folder, number of fg variants, random seed
+    Out: match file path
+    """
+    rng=random.Random(seed)
+    fg_path=os.path.join(folder,"FG.gz")
+    ext_path=os.path.join(folder,"EXT.tsv")
+    variants=[]
+    with BgzfWriter(fg_path) as f:
+        f.write("\t".join(FG_COLS)+"\n")
+        for chrom in CHROMS:
+            pos=0
+            for _ in range(n_variants//len(CHROMS)):
+                pos+=rng.randint(1,50)
+                ref,alt=rng.sample("ACGT",2)
+                row=(chrom,pos,ref,alt,"{:.5g}".format(rng.gauss(0,0.1)),"{:.4g}".format(10**-rng.uniform(0,300)),"{:.4g}".format(rng.uniform(0.005,0.2)))
+                variants.append(row)
+                f.write("\t".join(map(str,row))+"\n")
+    tabix_index(fg_path,1,2,2,"#",0)
+    with open(ext_path,"w") as f:
+        f.write("\t".join(EXT_COLS)+"\n")
+        for chrom,pos,ref,alt,beta,pval,se in rng.sample(variants,len(variants)*2//3):
+            if rng.random() < 0.3:
+                ref,alt=alt,ref
+            f.write("{}\t{}\t{}\t{}\t{:.5g}\t{}\t{}\tdoi:test\n".format(chrom,pos,ref,alt,rng.gauss(0,0.1),pval,se))
+    match_file=os.path.join(folder,"match.tsv")
+    with open(match_file,"w") as f:
+        f.write("{}\t{}\n".format(ext_path,fg_path))
+    return match_file
+
+def run(folder, match_file, name, options):
+    """Match with the given options into a subfolder
+    Out: bytes of the matched table
+    """
+    out_f=os.path.join(folder,name)
+    os.makedirs(out_f)
+    cwd=os.getcwd()
+    os.chdir(out_f)
+    try:
+        main(EXT_COLS,FG_COLS,match_file,out_f,1.0,options)
+    finally:
+        os.chdir(cwd)
+    with open(os.path.join(out_f,"EXTxFG.betas.tsv"),"rb") as f:
+        return f.read()
+
+def test_index_matches_region(tmp_path):
+    folder=str(tmp_path)
+    match_file=write_inputs(folder)
+    build_index(os.path.join(folder,"FG.gz"),list(FG_COLS),os.path.join(folder,"FG.gz.bmidx"))
+    expected=run(folder,match_file,"region",MatchOptions(lookup="region"))
+    assert run(folder,match_file,"index",MatchOptions(lookup="index")) == expected
+    assert run(folder,match_file,"stream",MatchOptions(lookup="stream")) == expected
+
+def test_compact_lookups(tmp_path, monkeypatch):
+    """Compact mode converts region queries batch by batch and stream chunks one by one"""
+    folder=str(tmp_path)
+    match_file=write_inputs(folder)
+    build_index(os.path.join(folder,"FG.gz"),list(FG_COLS),os.path.join(folder,"FG.gz.bmidx"))
+    expected=run(folder,match_file,"region",MatchOptions(lookup="region"))
+    monkeypatch.setattr(fg_lookup,"REGION_BATCH",300)
+    for lookup in ("region","stream","index"):
+        assert run(folder,match_file,"compact_"+lookup,MatchOptions(lookup=lookup,compact=True)) == expected
+
+def test_chunked_scan_matches_unchunked(tmp_path, monkeypatch):
+    """Above the stream threshold, chunks are served by a temporary index of the fg file"""
+    folder=str(tmp_path)
+    match_file=write_inputs(folder)
+    monkeypatch.setattr(betamatch,"STREAM_THRESHOLD",1000)
+    built=[]
+    monkeypatch.setattr(betamatch,"build_index",lambda *args: built.append(args) or build_index(*args))
+    expected=run(folder,match_file,"region",MatchOptions(lookup="region"))
+    assert run(folder,match_file,"chunked",MatchOptions(chunk_size=300)) == expected
+    assert len(built) == 1
+    assert run(folder,match_file,"unchunked",MatchOptions()) == expected
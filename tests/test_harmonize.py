@@ -0,0 +1,137 @@
+#! /usr/bin/env python3
+"""Equivalence of the columnar allele harmonization with the row-wise functions it replaced.
+The reference functions below are the ones betamatch.py used before harmonize.py, applied row by row.
+"""
+import os, random, re, sys
+import numpy as np
+import pandas as pd
+
+REPO=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,REPO)
+
+from harmonize import harmonize, valid_alleles, flip_beta, flip_unified_strand
+from betamatch import ExtCols, FGCols, UNIFIED_PREFIX, join_betas
+
+VALID_ALLELE='^[acgtACGT]+$'
+
+def ref_flip_unified_strand(a1,a2):
+    """
+    Flips alleles to the A strand if necessary
+    """
+    allele_dict={"T":"A","C":"G","G":"C"}
+     # check if the A variant is present
+    if 'A' not in a1 + a2 and 'a' not in a1+a2:
+        # for both/ref and alt map them to the A strand and order each one lexicographically
+        a1 = ''.join([allele_dict[elem.upper()] for elem in a1])
+        a2 = ''.join([allele_dict[elem.upper()] for elem in a2])
+    return (a1,a2)
+
+def ref_flip_beta(r1,a1,beta1,beta2):
+    """If beta1 <0, flip betas (and consequently alleles)
+    """
+    if beta1 < 0:
+        return (a1,r1,-beta1,-beta2)
+    else:
+        return (r1,a1,beta1,beta2)
+
+def ref_harmonize(data, ref, alt, beta, prefix=UNIFIED_PREFIX):
+    """Row-wise unified alleles and beta, as in match_beta before harmonize.py"""
+    unif_ref,unif_alt,unif_beta=["{}{}".format(prefix,col) for col in ("ref","alt","beta")]
+    data[[unif_ref,unif_alt]]=data.loc[:,[ref,alt]].apply(lambda x: ref_flip_unified_strand(*x),axis=1,result_type="expand")
+    data[unif_beta]=data[beta]
+    data["sort_dir"]=data[[unif_ref,unif_alt]].apply(lambda x: -1 if (sorted(list(x)) != list(x)) else 1,axis=1)
+    data[[unif_ref,unif_alt]]=data[[unif_ref,unif_alt]].apply(lambda x: sorted(list(x)),axis=1,result_type="expand")
+    data[unif_beta]=data["sort_dir"]*data[unif_beta]
+    return data.drop(labels="sort_dir",axis="columns")
+
+def random_alleles(rng, n, invalid=0.0):
+    """Random mixed case alleles of 1-6 bases, with a share of invalid ones"""
+    out=[]
+    for _ in range(n):
+        if rng.random() < invalid:
+            out.append(rng.choice(["-","N","AN","<DEL>","A-T",""]))
+        else:
+            out.append("".join(rng.choice("ACGTacgt") for _ in range(rng.choice([1,1,1,2,3,6]))))
+    return out
+
+def random_betas(rng, n):
+    return [rng.choice([0.0,rng.gauss(0,1)]) for _ in range(n)]
+
+def test_valid_alleles():
+    rng=random.Random(1)
+    alleles=pd.Series(random_alleles(rng,2000,invalid=0.3))
+    expected=alleles.apply(lambda x: bool(re.match(VALID_ALLELE,x)))
+    assert valid_alleles(alleles).tolist() == expected.tolist()
+
+def test_flip_unified_strand():
+    rng=random.Random(2)
+    ref=pd.Series(random_alleles(rng,2000))
+    alt=pd.Series(random_alleles(rng,2000))
+    expected=[ref_flip_unified_strand(r,a) for r,a in zip(ref,alt)]
+    flip_ref,flip_alt=flip_unified_strand(ref,alt)
+    assert list(zip(flip_ref,flip_alt)) == expected
+
+def test_harmonize():
+    rng=random.Random(3)
+    n=2000
+    data=pd.DataFrame({"ref":random_alleles(rng,n),"alt":random_alleles(rng,n),"beta":random_betas(rng,n)})
+    expected=ref_harmonize(data.copy(),"ref","alt","beta")
+    result=harmonize(data.copy(),"ref","alt","beta")
+    for col in ("unif_ref","unif_alt","unif_beta"):
+        assert result[col].tolist() == expected[col].tolist()
+
+def test_flip_beta():
+    rng=random.Random(4)
+    n=2000
+    ref=pd.Series(random_alleles(rng,n))
+    alt=pd.Series(random_alleles(rng,n))
+    beta1=pd.Series(random_betas(rng,n)+[np.nan]*10)
+    beta2=pd.Series(random_betas(rng,n)+[np.nan]*10)
+    ref=pd.concat([ref,pd.Series(["A"]*10)],ignore_index=True)
+    alt=pd.concat([alt,pd.Series(["C"]*10)],ignore_index=True)
+    expected=[ref_flip_beta(*row) for row in zip(ref,alt,beta1,beta2)]
+    result=list(zip(*flip_beta(ref,alt,beta1,beta2)))
+    assert [r[:2] for r in result] == [e[:2] for e in expected]
+    np.testing.assert_array_equal(np.array([r[2:] for r in result]),np.array([e[2:] for e in expected]))
+
+def test_join_betas():
+    """unif_ref, unif_alt and unif_beta_* of the joined table are the ones of the row-wise implementation"""
+    rng=random.Random(5)
+    n=1500
+    info_ext=ExtCols("chr","pos","ref","alt","beta","pval","se","doi")
+    info_fg=FGCols("#chrom","pos","ref","alt","beta","pval","sebeta")
+    pos=[str(rng.randint(1,300)) for _ in range(n)]
+    ext=pd.DataFrame({"chr":"1","pos":pos,"ref":random_alleles(rng,n,invalid=0.1),"alt":random_alleles(rng,n,invalid=0.1),
+        "beta":random_betas(rng,n),"pval":0.5,"se":0.1,"doi":"x"})
+    #fg variants at the same positions, with the alleles of the external variant, swapped or strand flipped
+    fg_rows=[]
+    for p,r,a in zip(pos,ext["ref"],ext["alt"]):
+        choice=rng.random()
+        if choice < 0.3:
+            r,a=a,r
+        elif choice < 0.5:
+            r,a=random_alleles(rng,2)
+        fg_rows.append(("1",p,r,a,rng.gauss(0,1),0.5,0.1))
+    fg=pd.DataFrame(fg_rows,columns=list(info_fg)).drop_duplicates(subset=["pos","ref","alt"])
+
+    valid=valid_alleles(ext["ref"]) & valid_alleles(ext["alt"])
+    ext_valid=ext[valid].copy()
+    ext_valid["ref"]=ext_valid["ref"].str.upper()
+    ext_valid["alt"]=ext_valid["alt"].str.upper()
+    invalid_ext=ext[~valid].copy()
+    invalid_ext["invalid_data"]="YES"
+    fg_valid=fg[valid_alleles(fg["ref"]) & valid_alleles(fg["alt"])].copy()
+
+    result=join_betas(harmonize(ext_valid.copy(),"ref","alt","beta"),invalid_ext,harmonize(fg_valid.copy(),"ref","alt","beta"),info_ext,info_fg)
+
+    expected=pd.merge(pd.concat([ref_harmonize(ext_valid.copy(),"ref","alt","beta"),invalid_ext],sort=False),
+        ref_harmonize(fg_valid.copy(),"ref","alt","beta").rename(columns={info_fg[i]:info_ext[i] for i in range(len(info_fg))}),
+        how="left",on=["chr","pos","unif_alt","unif_ref"],suffixes=("_ext","_fg"))
+    cols=["unif_ref","unif_alt","unif_beta_ext","unif_beta_fg"]
+    expected[cols]=expected[cols].apply(lambda x: ref_flip_beta(*x),axis=1,result_type="expand")
+
+    assert result.shape[0] == expected.shape[0]
+    assert result["unif_ref"].tolist() == expected["unif_ref"].tolist()
+    assert result["unif_alt"].tolist() == expected["unif_alt"].tolist()
+    for col in ("unif_beta_ext","unif_beta_fg"):
+        np.testing.assert_array_equal(result[col].to_numpy(dtype=float),expected[col].to_numpy(dtype=float))